@@ -3,383 +3,905 @@ Coffee Lot Lineage Tracker - Backend Processor
 Performs VLOOKUP, inner joins, and recursive lineage tracing on Excel data
 """
 
+import numpy as np
 import pandas as pd
-from typing import Dict, List, Set, Optional, Any
-from datetime import datetime
+from typing import Dict, List, Optional, Any
+from contextlib import contextmanager
+import gc
 import json
+import logging
+import os
+import shutil
+
+log = logging.getLogger(__name__)
+
+try:
+    import python_calamine  # noqa: F401  (Rust XLSX reader used by pandas' calamine engine)
+    _EXCEL_ENGINE = 'calamine'
+except ImportError:
+    # pandas opens workbooks read-only / data-only with openpyxl
+    _EXCEL_ENGINE = 'openpyxl'
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from numba import njit  # compiles the integer-coded lineage walk
+except ImportError:
+    njit = None
+
+try:
+    import pyarrow  # noqa: F401  (Parquet engine for the parsed sheet cache, Arrow strings)
+    _PARQUET_CACHE = True
+    _TEXT_DTYPE = pd.StringDtype('pyarrow')
+except ImportError:
+    _PARQUET_CACHE = False
+    _TEXT_DTYPE = None
+
+# Repeated key columns, stored stripped and as categoricals
+_KEY_COLUMNS = ['Lot No_', 'Prod_ Order No_', 'Document Type', 'Process Type', 'Lots']
+_KEY_DTYPES = {column: 'string' for column in _KEY_COLUMNS}
+
+# Lineage node field -> (consumption sheet column, default when the sheet lacks it)
+_NODE_FIELDS = {
+    'prodOrderNo': ('Prod_ Order No_', ''),
+    'description': ('Description', ''),
+    'quantity': ('Quantity', 0),
+    'unit': ('Unit of Measure', ''),
+    'postingDate': ('Posting Date', ''),
+    'documentType': ('Document Type', ''),
+}
+
+# Names given to purchase sheet columns 2-11 by the VLOOKUP
+_VLOOKUP_COLUMNS = [
+    'VLOOKUP_Col2', 'VLOOKUP_Description', 'VLOOKUP_Quantity', 'VLOOKUP_Unit',
+    'VLOOKUP_Contract', 'VLOOKUP_Season', 'VLOOKUP_DeliveryDate', 'VLOOKUP_Origin',
+    'VLOOKUP_Certification', 'VLOOKUP_Counterparty'
+]
+
+
+def _categorize_keys(df: pd.DataFrame) -> pd.DataFrame:
+    """Strip the key columns of a sheet and store them as categoricals (blank -> NA)"""
+    for column in _KEY_COLUMNS:
+        if column in df.columns:
+            values = df[column].astype('string').str.strip()
+            df[column] = values.replace('', pd.NA).astype('category')
+    return df
+
+
+def _compact_text(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Store all-text object columns as Arrow strings (one UTF-8 buffer per column rather
+    than a Python str per cell, already the default on pandas 3), and text columns that
+    mostly repeat a few values (units, item numbers, descriptions) as categoricals;
+    numeric and date columns keep their NumPy dtypes
+    """
+    for column in df.columns:
+        values = df[column]
+        if values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) != 'string':
+            continue
+        if not pd.api.types.is_string_dtype(values.dtype):
+            continue
+        if values.nunique() < len(values) / 2:
+            df[column] = values.astype('category')
+        elif values.dtype == object and _TEXT_DTYPE is not None:
+            df[column] = values.astype(_TEXT_DTYPE)
+    return df
+
+
+def _parse_sheet(excel_file: pd.ExcelFile, sheet_name: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Parse a sheet, reading key columns as strings (no type inference) and categorizing them
+    and compacting other text columns; with columns given, every other column is skipped
+    """
+    usecols = (lambda column: column in columns) if columns else None
+    return _compact_text(_categorize_keys(excel_file.parse(sheet_name, usecols=usecols, dtype=_KEY_DTYPES)))
+
+
+# Bump when parsing changes what a cached sheet holds (columns, dtypes)
+_SHEET_CACHE_VERSION = 4
+
+
+def _sheet_cache_dir(file_path: str) -> str:
+    """
+    Parquet cache directory for a workbook, named after its modification time
+    and size so an edited workbook never reads stale sheets
+    """
+    stat = os.stat(file_path)
+    return os.path.join(f"{file_path}.cache", f"v{_SHEET_CACHE_VERSION}-{stat.st_mtime_ns}-{stat.st_size}")
+
+
+def _prepare_sheet_cache(cache_dir: str):
+    """Create a workbook version's cache directory, dropping caches of older versions"""
+    cache_root = os.path.dirname(cache_dir)
+    if not os.path.isdir(cache_dir):
+        if os.path.isdir(cache_root):
+            for stale in os.listdir(cache_root):
+                shutil.rmtree(os.path.join(cache_root, stale), ignore_errors=True)
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+def _write_sheet_cache(cache_dir: str, sheet_name: str, df: pd.DataFrame):
+    """Persist a parsed sheet to the cache"""
+    path = os.path.join(cache_dir, f"{sheet_name}.parquet")
+    try:
+        df.to_parquet(f"{path}.tmp", engine='pyarrow', compression='zstd')
+        os.replace(f"{path}.tmp", path)
+    except (ValueError, TypeError, OSError) as e:
+        # e.g. a column mixing numbers and text that Arrow cannot type. Such a sheet is
+        # not cached in another format: text casts would change its cells' types, and
+        # a pickle next to the workbook could run code when loaded
+        log.warning("Sheet '%s' not cached, it is parsed from the workbook on each load: %s", sheet_name, e)
+        if os.path.exists(f"{path}.tmp"):
+            os.remove(f"{path}.tmp")
+
+
+def _read_sheets(file_path: str, sheet_columns: Dict[str, Optional[List[str]]],
+                 cache_dir: Optional[str] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Parse the requested sheets (sheet name -> columns to keep, None for all) that
+    exist in the workbook. Sheets found in cache_dir are read from Parquet, and
+    requested sheets the workbook lacks are recorded there as absent, so the workbook
+    is only opened for the sheets the cache misses; those are parsed from a single
+    ExcelFile handle and then cached
+    """
+    sheets = {}
+    absent = set()
+    if cache_dir:
+        for name in sheet_columns:
+            path = os.path.join(cache_dir, name)
+            if os.path.exists(f"{path}.parquet"):
+                sheets[name] = pd.read_parquet(f"{path}.parquet", engine='pyarrow')
+            elif os.path.exists(f"{path}.absent"):
+                absent.add(name)
+    
+    missing = [name for name in sheet_columns if name not in sheets and name not in absent]
+    if missing:
+        with pd.ExcelFile(file_path, engine=_EXCEL_ENGINE) as excel_file:
+            sheets.update((name, _parse_sheet(excel_file, name, sheet_columns[name]))
+                          for name in missing if name in excel_file.sheet_names)
+        
+        if cache_dir:
+            try:
+                _prepare_sheet_cache(cache_dir)
+                for name in missing:
+                    if name in sheets:
+                        _write_sheet_cache(cache_dir, name, sheets[name])
+                    else:
+                        open(os.path.join(cache_dir, f"{name}.absent"), 'w').close()
+            except OSError as e:
+                log.warning("Sheet cache not written: %s", e)
+    
+    return {name: sheets[name] for name in sheet_columns if name in sheets}
+
+
+def _values(records: pd.DataFrame, column: str, default: Any = '') -> pd.Series:
+    """Column of records, or default for every row when the sheet lacks the column"""
+    if column in records.columns:
+        return records[column]
+    return pd.Series(default, index=records.index)
+
+
+def _join_keys(records: pd.DataFrame, column: str) -> pd.Series:
+    """
+    Stripped string keys of a column ('' for blanks or a missing column); key
+    columns were already stripped on load, other columns are stripped here at once
+    """
+    values = _values(records, column).astype('string')
+    if column not in _KEY_COLUMNS:
+        values = values.str.strip()
+    return values.fillna('')
+
+
+def _row_values(values: pd.Series) -> List[Any]:
+    """Column as a list of Python values for per-row reads (blanks are NaN, NaT for dates)"""
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        # Few distinct dates: box each one once and share the Timestamps between rows
+        codes, dates = pd.factorize(values)
+        boxed = dates.tolist() + [pd.NaT]
+        return [boxed[code] for code in codes.tolist()]
+    return values.to_numpy(dtype=object, na_value=np.nan).tolist()
+
+
+@contextmanager
+def _gc_paused():
+    """
+    Pause the cyclic garbage collector while building many acyclic records (dicts and
+    tuples of plain values), which would otherwise trigger repeated full collections
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _category_codes(values: pd.Series):
+    """Integer category codes of a column (-1 for NA) and the code of each category"""
+    values = values.astype('category')
+    return values.cat.codes.to_numpy(), {category: code for code, category in enumerate(values.cat.categories)}
+
+
+def _lots_of_type(lots: np.ndarray, lot_codes: np.ndarray, document_type_codes: np.ndarray,
+                  positions: np.ndarray, document_type_code: int) -> List[str]:
+    """
+    Lot numbers of the rows at positions with the given Document Type code, in record
+    order; compares integer codes, blank lots (code -1) are skipped
+    """
+    matches = positions[(document_type_codes[positions] == document_type_code) & (lot_codes[positions] >= 0)]
+    return lots[matches].tolist()
+
+
+def _lists_by_code(codes: np.ndarray, values: np.ndarray) -> Dict[int, List[Any]]:
+    """
+    Values grouped into a list per category code (code -1, NA, is dropped) keeping
+    their order within each code: one stable sort and split instead of a Python
+    call per group
+    """
+    order = np.argsort(codes, kind='stable')
+    present, starts = np.unique(codes[order], return_index=True)
+    groups = np.split(values[order], starts[1:])
+    return {code: group.tolist() for code, group in zip(present.tolist(), groups) if code >= 0}
+
+
+def _norm(values: pd.Series) -> pd.Series:
+    """Normalize values for comparison"""
+    return values.astype('string').str.strip().str.upper()
+
+
+def _keyed(df: pd.DataFrame, key_column: str, next_key_column: Optional[str] = None,
+           **columns: str) -> pd.DataFrame:
+    """
+    Project a sheet onto renamed columns (new name -> sheet column) plus a
+    normalized `_key` built from key_column; rows with a blank key are dropped.
+    When next_key_column is given it is normalized here, once per sheet row, and
+    carried as `_next_key` to become the join key of the following step
+    """
+    needed = {key_column, next_key_column or key_column, *columns.values()}
+    if not needed <= set(df.columns):
+        return pd.DataFrame(columns=[*columns, '_key'] + (['_next_key'] if next_key_column else []))
+    
+    keyed = pd.DataFrame({name: df[source] for name, source in columns.items()})
+    keyed['_key'] = _norm(df[key_column])
+    if next_key_column:
+        keyed['_next_key'] = _norm(df[next_key_column])
+    return keyed[keyed['_key'].fillna('') != '']
+
+
+def _join_on_key(left: pd.DataFrame, right: pd.DataFrame, keep: List[str]) -> pd.DataFrame:
+    """
+    Inner hash-join two keyed frames on `_key` and keep the given columns;
+    a `_next_key` carried by right becomes the `_key` of the result
+    """
+    left = left[left['_key'].fillna('') != '']
+    joined = left.merge(right, on='_key', how='inner')
+    if '_next_key' in joined.columns:
+        return joined[keep + ['_next_key']].rename(columns={'_next_key': '_key'})
+    return joined[keep]
+
+
+def _adjacency(keys: np.ndarray, values: np.ndarray, size: int):
+    """CSR adjacency (indptr, indices) listing the values of each key 0..size-1 in input order"""
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=size), out=indptr[1:])
+    return indptr, values[np.argsort(keys, kind='stable')].astype(np.int64)
+
+
+def _walk_lineage(start, max_depth, lot_order, lot_known, order_lots_ptr, order_lots,
+                  lot_orders_ptr, lot_orders, order_outputs_ptr, order_outputs):
+    """
+    Integer-coded lineage walk visiting lots in the same order as get_lot_lineage's
+    Python walk. Takes each lot's production order and known flag plus CSR adjacency
+    of production order -> consumed lots, lot -> consuming orders and order -> output
+    lots. Returns the number of visited lots, the number of traced nodes and, per
+    node in visit order, its lot, parent node (-1 for the root), depth and direction
+    (0 origin, 1 destination, 2 both)
+    """
+    n_lots = lot_known.shape[0]
+    visited_lots = np.zeros(n_lots, dtype=np.bool_)
+    visited_origin_orders = np.zeros(order_lots_ptr.shape[0] - 1, dtype=np.bool_)
+    visited_dest_orders = np.zeros(order_lots_ptr.shape[0] - 1, dtype=np.bool_)
+    node_lot = np.empty(n_lots, dtype=np.int64)
+    node_parent = np.empty(n_lots, dtype=np.int64)
+    node_depth = np.empty(n_lots, dtype=np.int64)
+    node_direction = np.empty(n_lots, dtype=np.int64)
+    # Stack frames: node, phase (0 start, 1 origins, 2 destinations, 3 done), current
+    # production order, position in its consumed lots, position in the lot's consuming
+    # orders and position in the current order's outputs (-1 between orders)
+    frame_node = np.empty(n_lots, dtype=np.int64)
+    frame_phase = np.empty(n_lots, dtype=np.int64)
+    frame_order = np.empty(n_lots, dtype=np.int64)
+    frame_origin = np.empty(n_lots, dtype=np.int64)
+    frame_orders = np.empty(n_lots, dtype=np.int64)
+    frame_output = np.empty(n_lots, dtype=np.int64)
+    
+    visited_lots[start] = True
+    n_visited = 1
+    node_lot[0], node_parent[0], node_depth[0], node_direction[0] = start, -1, 0, 2
+    n_nodes = 1
+    top = 0
+    frame_node[0], frame_phase[0] = 0, 0
+    
+    while top >= 0:
+        node = frame_node[top]
+        lot = node_lot[node]
+        direction = node_direction[node]
+        phase = frame_phase[top]
+        child, child_direction = -1, 0
+        while child < 0 and phase != 3:
+            if phase == 0:
+                # Origins come from the node's production order, once per trace
+                phase = 2
+                frame_orders[top] = lot_orders_ptr[lot]
+                frame_output[top] = -1
+                order = lot_order[lot]
+                if direction != 1 and order >= 0 and not visited_origin_orders[order]:
+                    visited_origin_orders[order] = True
+                    frame_order[top] = order
+                    frame_origin[top] = order_lots_ptr[order]
+                    phase = 1
+            elif phase == 1:
+                order = frame_order[top]
+                i = frame_origin[top]
+                if i < order_lots_ptr[order + 1]:
+                    frame_origin[top] = i + 1
+                    if order_lots[i] != lot:
+                        child, child_direction = order_lots[i], 0
+                else:
+                    phase = 2
+            elif direction == 0:
+                phase = 3
+            elif frame_output[top] < 0:
+                # Next production order consuming the lot that is not visited yet
+                i = frame_orders[top]
+                if i < lot_orders_ptr[lot + 1]:
+                    frame_orders[top] = i + 1
+                    order = lot_orders[i]
+                    if not visited_dest_orders[order]:
+                        frame_order[top] = order
+                        frame_output[top] = order_outputs_ptr[order]
+                else:
+                    phase = 3
+            else:
+                order = frame_order[top]
+                i = frame_output[top]
+                if i < order_outputs_ptr[order + 1]:
+                    frame_output[top] = i + 1
+                    if order_outputs[i] != lot:
+                        child, child_direction = order_outputs[i], 1
+                else:
+                    # Done once all of the order's outputs were enumerated
+                    visited_dest_orders[order] = True
+                    frame_output[top] = -1
+        frame_phase[top] = phase
+        
+        if child < 0:
+            top -= 1
+            continue
+        depth = node_depth[node] + 1
+        if depth > max_depth or visited_lots[child]:
+            continue
+        visited_lots[child] = True
+        n_visited += 1
+        if not lot_known[child]:
+            continue
+        
+        node_lot[n_nodes], node_parent[n_nodes] = child, node
+        node_depth[n_nodes], node_direction[n_nodes] = depth, child_direction
+        top += 1
+        frame_node[top], frame_phase[top] = n_nodes, 0
+        n_nodes += 1
+    
+    return n_visited, n_nodes, node_lot, node_parent, node_depth, node_direction
+
+
+if njit is not None:
+    _walk_lineage = njit(cache=True)(_walk_lineage)
+
 
 class CoffeeLotLineageTracker:
-    def __init__(self):
-        self.records = []
-        self.production_purchase = []
-        self.acom_navision_purchase = []
+    def __init__(self, verbose: bool = False):
+        # Progress messages are logged at INFO, and only by verbose trackers; the logger's
+        # level and handlers are left to the application
+        self.verbose = verbose
+        self.records_df = pd.DataFrame()
+        self.production_purchase = pd.DataFrame()
+        self.acom_navision_purchase = pd.DataFrame()
         # Additional sheets for 5-step join
-        self.eacl_navision = []
-        self.acom_sale = []
-        self.acom_nav_transform = []
-        self.acom_nav_bridge = []
-        self.acom_production_results = []
+        self.eacl_navision = pd.DataFrame()
+        self.acom_sale = pd.DataFrame()
+        self.acom_nav_transform = pd.DataFrame()
+        self.acom_nav_bridge = pd.DataFrame()
+        self.acom_production_results = pd.DataFrame()
         # Indexes
-        self.lot_index = {}
-        self.prod_order_index = {}
-        self.purchase_lot_map = {}  # Maps sale contract # to consumption lots
-        
-    def load_excel_file(self, file_path: str, main_sheet: str = 'ACOM Production Consumption'):
-        """Load Excel file and all relevant sheets"""
-        print(f"Loading Excel file: {file_path}")
-        
-        # Read all sheets
-        excel_file = pd.ExcelFile(file_path)
+        self.lot_index = {}  # Lot -> row positions in records_df
+        self.prod_order_index = {}  # Production order -> row positions in records_df
+        self.consumed_lot_to_prod_orders = {}  # Lot -> production orders consuming it
+        self.prod_order_to_outputs = {}  # Production order -> output lots
+        self.consumption_by_prod_order = pd.DataFrame(columns=['prodOrder', 'consumptionLot'])  # Consumption rows for step 5
+        self.purchase_lot_map: Dict[str, List[str]] = {}  # Maps sale contract # to consumption lots
+        self._lineage_cache = {}  # (lot, max_depth) -> lineage result, reset with the indexes
+        self._lineage_graph = None  # Integer-coded indexes for the compiled walk (numba only)
+        self.lot_stats = pd.DataFrame()  # Lot -> get_lot_statistics aggregates
+        
+    def _info(self, msg: str, *args: Any):
+        """Log a progress message at INFO when this tracker is verbose"""
+        if self.verbose:
+            log.info(msg, *args)
+    
+    def load_excel_file(self, file_path: str, main_sheet: str = 'ACOM Production Consumption',
+                        use_cache: bool = True):
+        """
+        Load Excel file and all relevant sheets
         
-        # Load main sheet
-        if main_sheet in excel_file.sheet_names:
-            df_main = pd.read_excel(file_path, sheet_name=main_sheet)
-            self.records = df_main.to_dict('records')
-            print(f"Loaded {len(self.records)} records from {main_sheet}")
+        With use_cache (and pyarrow installed) parsed sheets are kept as Parquet in
+        <file_path>.cache/ and reused until the workbook changes
+        """
+        self._info("Loading Excel file: %s (engine: %s)", file_path, _EXCEL_ENGINE)
+        cache_dir = _sheet_cache_dir(file_path) if use_cache and _PARQUET_CACHE else None
         
         # Load all additional sheets (7 total)
+        # Sheet -> (attribute, columns to read); the 5-step join sheets only keep
+        # their join columns, None reads every column
         sheet_mappings = {
-            'ACOM Navision Purchase': 'acom_navision_purchase',
-            'Production Purchase': 'production_purchase',
-            'EACL Navision': 'eacl_navision',
-            'ACOM Navision Sale': 'acom_sale',
-            'ACOM Nav Transform': 'acom_nav_transform',
-            'ACOM Nav Bridge': 'acom_nav_bridge',
-            'ACOM Production Results ': 'acom_production_results'  # Note the space
+            'ACOM Navision Purchase': ('acom_navision_purchase', None),
+            'Production Purchase': ('production_purchase', None),
+            'EACL Navision': ('eacl_navision', ['Lot Number', 'Sale Contract #']),
+            'ACOM Navision Sale': ('acom_sale', ['Sale Contract', 'Lot #']),
+            'ACOM Nav Transform': ('acom_nav_transform', ['Sale Lot', 'Production Lot']),
+            'ACOM Nav Bridge': ('acom_nav_bridge', ['Lot No_(O)', 'Lot No_(D)']),
+            'ACOM Production Results ': ('acom_production_results', ['Lot No_', 'Prod_ Order No_'])  # Note the space
         }
         
-        for sheet_name, attr_name in sheet_mappings.items():
-            if sheet_name in excel_file.sheet_names:
-                df = pd.read_excel(file_path, sheet_name=sheet_name)
-                setattr(self, attr_name, df.to_dict('records'))
-                print(f"Loaded {len(df)} records from {sheet_name}")
+        sheet_columns = {main_sheet: None}
+        sheet_columns.update((sheet_name, columns) for sheet_name, (_, columns) in sheet_mappings.items())
+        sheets = _read_sheets(file_path, sheet_columns, cache_dir)
+        
+        # Load main sheet
+        if main_sheet in sheets:
+            self.records_df = sheets[main_sheet]
+            self._info("Loaded %s records from %s", len(self.records_df), main_sheet)
+        
+        for sheet_name, (attr_name, _) in sheet_mappings.items():
+            if sheet_name in sheets:
+                df = sheets[sheet_name]
+                setattr(self, attr_name, df)
+                self._info("Loaded %s records from %s", len(df), sheet_name)
             else:
-                print(f"WARNING: Sheet '{sheet_name}' not found")
+                log.warning("Sheet '%s' not found", sheet_name)
         
         # Perform VLOOKUP
         self.perform_vlookup()
         
+        # Preprocess data for efficient lookups (including step 5's consumption slice)
+        self.preprocess_data()
+        
         # Build purchase lot mapping (5-step join)
         self.build_purchase_lot_mapping()
         
-        # Preprocess data for efficient lookups
-        self.preprocess_data()
-        
     def perform_vlookup(self):
         """
         Perform VLOOKUP operation: Match Lot No_ from main sheet 
         with Lots column in Purchase sheet and merge data
         """
-        print("\n=== Performing VLOOKUP ===")
+        self._info("=== Performing VLOOKUP ===")
         
-        if not self.acom_navision_purchase:
-            print("No purchase data available for VLOOKUP")
+        if self.acom_navision_purchase.empty:
+            self._info("No purchase data available for VLOOKUP")
             return
         
-        # Create lookup dictionary: Lots -> Purchase Record
-        purchase_lookup = {}
-        for purchase in self.acom_navision_purchase:
-            lots = str(purchase.get('Lots', '')).strip()
-            if lots:
-                purchase_lookup[lots] = purchase
-        
-        print(f"Created purchase lookup with {len(purchase_lookup)} lots")
+        purchase = self.acom_navision_purchase
+        if 'Lots' not in purchase.columns or 'Lot No_' not in self.records_df.columns:
+            self._info("No Lots / Lot No_ column available for VLOOKUP")
+            return
         
-        # Merge purchase data into records
-        match_count = 0
-        for record in self.records:
-            lot_no = str(record.get('Lot No_', '')).strip()
-            
-            if lot_no and lot_no in purchase_lookup:
-                purchase_data = purchase_lookup[lot_no]
-                
-                # Get column keys from purchase data
-                purchase_cols = list(purchase_data.keys())
-                
-                # Map columns (simulating Excel VLOOKUP returning columns 2-11)
-                if len(purchase_cols) > 1:
-                    record['VLOOKUP_Col2'] = purchase_data.get(purchase_cols[1])
-                if len(purchase_cols) > 2:
-                    record['VLOOKUP_Description'] = purchase_data.get(purchase_cols[2])
-                if len(purchase_cols) > 3:
-                    record['VLOOKUP_Quantity'] = purchase_data.get(purchase_cols[3])
-                if len(purchase_cols) > 4:
-                    record['VLOOKUP_Unit'] = purchase_data.get(purchase_cols[4])
-                if len(purchase_cols) > 5:
-                    record['VLOOKUP_Contract'] = purchase_data.get(purchase_cols[5])
-                if len(purchase_cols) > 6:
-                    record['VLOOKUP_Season'] = purchase_data.get(purchase_cols[6])
-                if len(purchase_cols) > 7:
-                    record['VLOOKUP_DeliveryDate'] = purchase_data.get(purchase_cols[7])
-                if len(purchase_cols) > 8:
-                    record['VLOOKUP_Origin'] = purchase_data.get(purchase_cols[8])
-                if len(purchase_cols) > 9:
-                    record['VLOOKUP_Certification'] = purchase_data.get(purchase_cols[9])
-                if len(purchase_cols) > 10:
-                    record['VLOOKUP_Counterparty'] = purchase_data.get(purchase_cols[10])
-                
-                match_count += 1
-        
-        print(f"VLOOKUP completed: {match_count} matches found out of {len(self.records)} records")
+        # Lookup table: Lots -> purchase columns 2-11 (simulating Excel VLOOKUP),
+        # last row wins for duplicated lots
+        columns = purchase.columns[1:len(_VLOOKUP_COLUMNS) + 1]
+        # Keyed on the records' lot categories so the merge keeps Lot No_ categorical;
+        # lots that never occur in the records become NA and are dropped
+        lookup = purchase[columns].set_axis(_VLOOKUP_COLUMNS[:len(columns)], axis=1).assign(
+            _lot=purchase['Lots'].astype(self.records_df['Lot No_'].dtype))
+        lookup = lookup.dropna(subset=['_lot']).drop_duplicates('_lot', keep='last')
+        
+        self._info("Created purchase lookup with %s lots", len(lookup))
+        
+        # Merge purchase data into records (both keys were stripped on load), replacing
+        # the columns of an earlier VLOOKUP so a repeated call gives the same records;
+        # rows with a match are those that picked up a lookup key
+        records = self.records_df.drop(columns=_VLOOKUP_COLUMNS, errors='ignore')
+        merged = records.merge(lookup, left_on='Lot No_', right_on='_lot', how='left', sort=False)
+        match_count = int(merged['_lot'].notna().sum())
+        
+        # Unmatched rows would turn integer purchase columns into floats (2025.0):
+        # keep them integers, with NA for the unmatched rows
+        integer_columns = [column for column in lookup.columns
+                           if column != '_lot' and pd.api.types.is_integer_dtype(lookup[column].dtype)]
+        self.records_df = merged.drop(columns='_lot').astype({column: 'Int64' for column in integer_columns})
+        
+        self._info("VLOOKUP completed: %s matches found out of %s records", match_count, len(self.records_df))
     
     def build_purchase_lot_mapping(self):
         """
         Build mapping from Sale Contract # to consumption lots using 5-step join logic
         Matches the TypeScript implementation in excelParser.ts
+        
+        Each step is a pandas hash join on normalized (stripped, upper-cased) keys
         """
-        print("\n=== Building Purchase Lot Mapping (5-Step Join) ===")
+        self._info("=== Building Purchase Lot Mapping (5-Step Join) ===")
         
         self.purchase_lot_map = {}
         
-        def norm(v):
-            """Normalize values for comparison"""
-            return str(v if v is not None else '').strip().upper()
-        
         # Step 1: EACL Navision [Lot Number] -> ACOM Navision Sale [Sale Contract]
-        step1 = []
-        for eacl in self.eacl_navision:
-            lot_number = eacl.get('Lot Number')
-            if lot_number is None or str(lot_number).strip() == '':
-                continue
-            lot_norm = norm(lot_number)
-            
-            for acom in self.acom_sale:
-                if norm(acom.get('Sale Contract', '')) == lot_norm:
-                    step1.append({
-                        'lotNumber': str(lot_number),
-                        'saleContract': acom.get('Sale Contract'),
-                        'saleLot': acom.get('Lot #'),
-                        'saleContractNumber': eacl.get('Sale Contract #')  # Keep original sale contract #
-                    })
+        eacl = _keyed(self.eacl_navision, 'Lot Number',
+                      lotNumber='Lot Number', saleContractNumber='Sale Contract #')
+        step1 = _join_on_key(
+            eacl.assign(lotNumber=eacl['lotNumber'].astype(str)),
+            _keyed(self.acom_sale, 'Sale Contract', 'Lot #', saleContract='Sale Contract', saleLot='Lot #'),
+            ['lotNumber', 'saleContract', 'saleLot', 'saleContractNumber']
+        )
         
-        print(f"Step 1: EACL Navision [Lot Number] -> ACOM Sale: {len(step1)} matches")
+        self._info("Step 1: EACL Navision [Lot Number] -> ACOM Sale: %s matches", len(step1))
         
         # Step 2: ACOM Navision Sale [Lot #] -> ACOM Nav Transform [Sale Lot]
-        step2 = []
-        for item in step1:
-            for transform in self.acom_nav_transform:
-                if norm(transform.get('Sale Lot', '')) == norm(item['saleLot']):
-                    step2.append({
-                        'lotNumber': item['lotNumber'],
-                        'saleLot': item['saleLot'],
-                        'productionLot': transform.get('Production Lot'),
-                        'saleContractNumber': item['saleContractNumber']
-                    })
-        
-        print(f"Step 2: ACOM Sale -> ACOM Transform: {len(step2)} matches")
+        step2 = _join_on_key(
+            step1,
+            _keyed(self.acom_nav_transform, 'Sale Lot', 'Production Lot', productionLot='Production Lot'),
+            ['lotNumber', 'saleLot', 'productionLot', 'saleContractNumber']
+        )
+        
+        self._info("Step 2: ACOM Sale -> ACOM Transform: %s matches", len(step2))
         
         # Step 3: ACOM Nav Transform [Production Lot] -> ACOM Nav Bridge [Lot No_(O)]
-        step3 = []
-        for item in step2:
-            for bridge in self.acom_nav_bridge:
-                if norm(bridge.get('Lot No_(O)', '')) == norm(item['productionLot']):
-                    step3.append({
-                        'lotNumber': item['lotNumber'],
-                        'productionLot': item['productionLot'],
-                        'bridgeDestLot': bridge.get('Lot No_(D)'),
-                        'saleContractNumber': item['saleContractNumber']
-                    })
-        
-        print(f"Step 3: ACOM Transform -> ACOM Bridge: {len(step3)} matches")
+        step3 = _join_on_key(
+            step2,
+            _keyed(self.acom_nav_bridge, 'Lot No_(O)', 'Lot No_(D)', bridgeDestLot='Lot No_(D)'),
+            ['lotNumber', 'productionLot', 'bridgeDestLot', 'saleContractNumber']
+        )
+        
+        self._info("Step 3: ACOM Transform -> ACOM Bridge: %s matches", len(step3))
         
         # Step 4: ACOM Nav Bridge [Lot No_(D)] -> ACOM Production Results [Lot No_]
-        step4 = []
-        for item in step3:
-            for prod in self.acom_production_results:
-                if norm(prod.get('Lot No_', '')) == norm(item['bridgeDestLot']):
-                    prod_order = prod.get('Prod_ Order No_')
-                    step4.append({
-                        'lotNumber': item['lotNumber'],
-                        'bridgeDestLot': item['bridgeDestLot'],
-                        'prodOrder': prod_order,
-                        'saleContractNumber': item['saleContractNumber']
-                    })
-        
-        print(f"Step 4: ACOM Bridge -> ACOM Production Results: {len(step4)} matches")
+        step4 = _join_on_key(
+            step3,
+            _keyed(self.acom_production_results, 'Lot No_', prodOrder='Prod_ Order No_'),
+            ['lotNumber', 'bridgeDestLot', 'prodOrder', 'saleContractNumber']
+        )
+        
+        self._info("Step 4: ACOM Bridge -> ACOM Production Results: %s matches", len(step4))
         
         # Step 5: ACOM Production Results [Prod_ Order No_] -> ACOM Production Consumption [Prod_ Order No_] (Consumption only)
-        step5 = []
-        for item in step4:
-            # Find consumption records with matching production order
-            consumption_lots = [
-                r for r in self.records 
-                if r.get('Prod_ Order No_') == item['prodOrder'] 
-                and r.get('Process Type') == 'Consumption'
-            ]
-            
-            for lot in consumption_lots:
-                consumption_lot_no = lot.get('Lot No_')
-                step5.append({
-                    'lotNumber': item['lotNumber'],
-                    'prodOrder': item['prodOrder'],
-                    'consumptionLot': consumption_lot_no,
-                    'saleContractNumber': item['saleContractNumber']
-                })
-                
-                # Map Sale Contract # to consumption lots
-                sale_contract = str(item['saleContractNumber'])
-                if sale_contract not in self.purchase_lot_map:
-                    self.purchase_lot_map[sale_contract] = []
-                if consumption_lot_no not in self.purchase_lot_map[sale_contract]:
-                    self.purchase_lot_map[sale_contract].append(consumption_lot_no)
-        
-        print(f"Step 5: ACOM Production Results -> ACOM Consumption: {len(step5)} matches")
-        print(f"Purchase lot mapping built: {len(self.purchase_lot_map)} sale contracts")
-        
-        # Return all steps for debugging
-        return {
-            'step1': step1,
-            'step2': step2,
-            'step3': step3,
-            'step4': step4,
-            'step5': step5
-        }
+        consumption = self.consumption_by_prod_order
+        orders = step4
+        if isinstance(consumption['prodOrder'].dtype, pd.CategoricalDtype):
+            # Re-code step 4's orders with the consumption sheet's categories so the merge
+            # compares integer category codes (orders absent from the sheet become NA)
+            orders = step4.assign(prodOrder=step4['prodOrder'].astype(consumption['prodOrder'].dtype))
+        step5 = orders.dropna(subset=['prodOrder']).merge(consumption, on='prodOrder', how='inner')[
+            ['lotNumber', 'prodOrder', 'consumptionLot', 'saleContractNumber']
+        ]
+        
+        # Map Sale Contract # to consumption lots
+        lots_by_contract = step5.groupby(step5['saleContractNumber'].astype(str), sort=False)['consumptionLot'].unique()
+        # unique() already deduplicates each contract's lots by hashing; they are stored
+        # as sorted lists so the public map stays list-valued and deterministic
+        self.purchase_lot_map = {contract: sorted(lots) for contract, lots in lots_by_contract.items()}
+        
+        self._info("Step 5: ACOM Production Results -> ACOM Consumption: %s matches", len(step5))
+        self._info("Purchase lot mapping built: %s sale contracts", len(self.purchase_lot_map))
+        
+        # Return all steps for debugging (without the carried join keys)
+        steps = {'step1': step1, 'step2': step2, 'step3': step3, 'step4': step4, 'step5': step5}
+        return {name: step.drop(columns='_key', errors='ignore') for name, step in steps.items()}
     
-    def get_purchase_lot_lineage(self, sale_contract: str) -> List[Dict[str, Any]]:
+    def get_purchase_lot_lineage(self, sale_contract: str, max_depth: int = 10) -> List[Dict[str, Any]]:
         """
         Get lineage for all consumption lots linked to a purchase sale contract
         Returns list of lineage results, one for each consumption lot
         """
-        print(f"\n=== Getting Purchase Lot Lineage for Sale Contract: {sale_contract} ===")
+        self._info("=== Getting Purchase Lot Lineage for Sale Contract: %s ===", sale_contract)
         
         consumption_lots = self.purchase_lot_map.get(sale_contract, [])
         
         if not consumption_lots:
-            print(f"No consumption lots found for sale contract {sale_contract}")
+            self._info("No consumption lots found for sale contract %s", sale_contract)
             return []
         
-        print(f"Found {len(consumption_lots)} consumption lots for this sale contract")
+        self._info("Found %s consumption lots for this sale contract", len(consumption_lots))
         
-        results = []
-        for lot in consumption_lots:
-            lineage = self.get_lot_lineage(lot)
-            results.append(lineage)
-        
-        return results
+        return [self.get_lot_lineage(lot, max_depth) for lot in consumption_lots]
     
     def preprocess_data(self):
         """Build indexes for efficient lookups"""
-        print("\n=== Building indexes ===")
-        
-        # Index by Lot No_
-        for record in self.records:
-            lot_no = str(record.get('Lot No_', '')).strip()
-            if lot_no:
-                if lot_no not in self.lot_index:
-                    self.lot_index[lot_no] = []
-                self.lot_index[lot_no].append(record)
-        
-        # Index by Prod_ Order No_
-        for record in self.records:
-            prod_order = str(record.get('Prod_ Order No_', '')).strip()
-            if prod_order:
-                if prod_order not in self.prod_order_index:
-                    self.prod_order_index[prod_order] = []
-                self.prod_order_index[prod_order].append(record)
-        
-        print(f"Indexed {len(self.lot_index)} unique lot numbers")
-        print(f"Indexed {len(self.prod_order_index)} unique production orders")
+        self._info("=== Building indexes ===")
+        
+        self.lot_index = {}
+        self.prod_order_index = {}
+        self.consumed_lot_to_prod_orders = {}
+        self.prod_order_to_outputs = {}
+        self.consumption_by_prod_order = pd.DataFrame(columns=['prodOrder', 'consumptionLot'])
+        self._lineage_cache = {}
+        
+        # Index row positions by Lot No_ and by Prod_ Order No_ in one groupby each, in
+        # order of first appearance (blank keys are NA and dropped)
+        if 'Lot No_' in self.records_df.columns:
+            self.lot_index = self.records_df.groupby('Lot No_', sort=False, observed=True).indices
+        if 'Prod_ Order No_' in self.records_df.columns:
+            self.prod_order_index = self.records_df.groupby('Prod_ Order No_', sort=False, observed=True).indices
+        
+        # Key columns as category codes, taken once and shared by the tracer and the
+        # compiled walk's graph
+        lots = _values(self.records_df, 'Lot No_', None)
+        self._lot_codes, _ = _category_codes(lots)
+        self._prod_order_codes, _ = _category_codes(_values(self.records_df, 'Prod_ Order No_', None))
+        self._document_types, self._document_type_codes = _category_codes(
+            _values(self.records_df, 'Document Type', None))
+        
+        # Columns read row by row during tracing, as plain arrays / lists of Python values
+        self._lots = lots.to_numpy(dtype=object)
+        self._node_fields = {field: _row_values(_values(self.records_df, column, default))
+                             for field, (column, default) in _NODE_FIELDS.items()}
+        
+        # The link maps below all come from one selection of the key columns
+        keys = self.records_df[[column for column in _KEY_COLUMNS if column in self.records_df.columns]]
+        
+        # Step 5's Consumption rows (prodOrder, consumptionLot), kept categorical
+        if {'Prod_ Order No_', 'Lot No_', 'Process Type'} <= set(keys.columns):
+            self.consumption_by_prod_order = keys.loc[
+                keys['Process Type'] == 'Consumption', ['Prod_ Order No_', 'Lot No_']
+            ].rename(columns={'Prod_ Order No_': 'prodOrder', 'Lot No_': 'consumptionLot'})
+        
+        # Reverse indexes for destination tracing: consumed lot -> production orders
+        # (in prod_order_index order) and production order -> output lots
+        if {'Lot No_', 'Prod_ Order No_', 'Document Type'} <= set(keys.columns):
+            links = keys[['Lot No_', 'Prod_ Order No_', 'Document Type']].dropna().astype(
+                {'Lot No_': object, 'Prod_ Order No_': object})
+            document_type = links['Document Type']
+            
+            consumed = links[document_type == 'Consumption'].drop_duplicates(['Lot No_', 'Prod_ Order No_'])
+            prod_order_rank = {prod_order: i for i, prod_order in enumerate(self.prod_order_index)}
+            consumed = consumed.iloc[consumed['Prod_ Order No_'].map(prod_order_rank).argsort(kind='stable')]
+            self.consumed_lot_to_prod_orders = consumed.groupby('Lot No_', sort=False)['Prod_ Order No_'].agg(list).to_dict()
+            
+            outputs = links[document_type == 'Output']
+            self.prod_order_to_outputs = outputs.groupby('Prod_ Order No_', sort=False)['Lot No_'].agg(list).to_dict()
+        
+        self._lineage_graph = self._build_lineage_graph() if njit is not None else None
+        self.lot_stats = self._build_lot_stats()
+        
+        self._info("Indexed %s unique lot numbers", len(self.lot_index))
+        self._info("Indexed %s unique production orders", len(self.prod_order_index))
+    
+    def _build_lineage_graph(self) -> Optional[Dict[str, Any]]:
+        """
+        Integer-coded copy of the lineage indexes for _walk_lineage: lots and production
+        orders are their category codes in records_df
+        """
+        if not {'Lot No_', 'Prod_ Order No_', 'Document Type'} <= set(self.records_df.columns):
+            return None
+        lot_categories = self.records_df['Lot No_'].cat.categories
+        order_categories = self.records_df['Prod_ Order No_'].cat.categories
+        lots = self._lot_codes.astype(np.int64)
+        orders = self._prod_order_codes.astype(np.int64)
+        
+        # Each lot's production order is that of its first record
+        lot_known = np.zeros(len(lot_categories), dtype=np.bool_)
+        lot_order = np.full(len(lot_categories), -1, dtype=np.int64)
+        present, first_rows = np.unique(lots, return_index=True)
+        first_rows = first_rows[present >= 0]
+        lot_known[lots[first_rows]] = True
+        lot_order[lots[first_rows]] = orders[first_rows]
+        
+        # Production order -> consumed / output lots in record order
+        linked = (lots >= 0) & (orders >= 0)
+        consumed = linked & (self._document_types == self._document_type_codes.get('Consumption', -2))
+        produced = linked & (self._document_types == self._document_type_codes.get('Output', -2))
+        order_lots_ptr, order_lots = _adjacency(orders[consumed], lots[consumed], len(order_categories))
+        order_outputs_ptr, order_outputs = _adjacency(orders[produced], lots[produced], len(order_categories))
+        
+        # Lot -> consuming production orders, in consumed_lot_to_prod_orders order
+        consumers = [(lot, order) for lot, orders in self.consumed_lot_to_prod_orders.items() for order in orders]
+        consumer_lots = pd.Categorical([lot for lot, _ in consumers], categories=lot_categories).codes
+        consumer_orders = pd.Categorical([order for _, order in consumers], categories=order_categories).codes
+        lot_orders_ptr, lot_orders = _adjacency(consumer_lots.astype(np.int64), consumer_orders, len(lot_categories))
+        
+        return {
+            'lots': lot_categories.tolist(),
+            'lot_codes': {lot: code for code, lot in enumerate(lot_categories)},
+            'arrays': (lot_order, lot_known, order_lots_ptr, order_lots,
+                       lot_orders_ptr, lot_orders, order_outputs_ptr, order_outputs),
+        }
+    
+    def _build_lot_stats(self) -> pd.DataFrame:
+        """
+        get_lot_statistics' aggregates for every lot, indexed by lot: record count and
+        quantity total in one groupby, and the distinct document types, posting dates
+        and units of each lot from its distinct (lot, value) pairs rather than its rows,
+        split per lot with _lists_by_code
+        """
+        if 'Lot No_' not in self.records_df.columns:
+            return pd.DataFrame()
+        records = pd.DataFrame({
+            'Lot No_': self.records_df['Lot No_'].astype('category'),
+            'Quantity': pd.to_numeric(_values(self.records_df, 'Quantity', 0), errors='coerce'),
+            'Document Type': _values(self.records_df, 'Document Type'),
+            'Posting Date': _values(self.records_df, 'Posting Date'),
+            'Unit of Measure': _values(self.records_df, 'Unit of Measure'),
+        })
+        
+        def distinct(column: str) -> pd.DataFrame:
+            # Deduplicated in the column's own dtype, then as Python values
+            pairs = records[['Lot No_', column]].drop_duplicates()
+            return pairs.astype({column: object})
+        
+        def per_lot(pairs: pd.DataFrame, column: str) -> List[List[Any]]:
+            lists = _lists_by_code(pairs['Lot No_'].cat.codes.to_numpy(), pairs[column].to_numpy())
+            return [lists[code] for code in stats.index.codes]
+        
+        stats = records.groupby('Lot No_', sort=False, observed=True)['Quantity'].agg(
+            totalRecords='size', totalQuantity='sum')
+        stats['documentTypes'] = per_lot(distinct('Document Type'), 'Document Type')
+        stats['units'] = per_lot(distinct('Unit of Measure'), 'Unit of Measure')
+        # Posting dates as sorted distinct strings: sorted by lot then date once for all lots
+        posting_dates = distinct('Posting Date')
+        posting_dates['Posting Date'] = posting_dates['Posting Date'].map(str)
+        posting_dates = posting_dates.drop_duplicates().sort_values(['Lot No_', 'Posting Date'])
+        stats['postingDates'] = per_lot(posting_dates, 'Posting Date')
+        return stats
+    
+    def _lineage_node(self, lot: str, depth: int) -> Dict[str, Any]:
+        """Lineage node for a known lot, from its first record"""
+        row = self.lot_index[lot][0]
+        fields = self._node_fields
+        
+        return {
+            'lotNo': lot,
+            'prodOrderNo': fields['prodOrderNo'][row],
+            'description': fields['description'][row],
+            'quantity': fields['quantity'][row],
+            'unit': fields['unit'][row],
+            'postingDate': str(fields['postingDate'][row]),
+            'documentType': fields['documentType'][row],
+            'origins': [],
+            'destinations': [],
+            'depth': depth
+        }
+    
+    def _compiled_lineage(self, lot_no: str, max_depth: int) -> Dict[str, Any]:
+        """get_lot_lineage's walk run by the compiled _walk_lineage, for a known lot"""
+        graph = self._lineage_graph
+        n_visited, n_nodes, lots, parents, depths, directions = _walk_lineage(
+            graph['lot_codes'][lot_no], max_depth, *graph['arrays'])
+        
+        nodes = []
+        for lot, parent, depth, direction in zip(lots[:n_nodes].tolist(), parents[:n_nodes].tolist(),
+                                                 depths[:n_nodes].tolist(), directions[:n_nodes].tolist()):
+            node = self._lineage_node(graph['lots'][lot], depth)
+            if parent >= 0:
+                nodes[parent]['origins' if direction == 0 else 'destinations'].append(node)
+            nodes.append(node)
+        
+        return {
+            'queriedLot': lot_no,
+            'lineageTree': nodes[0],
+            'totalNodesTraced': n_visited
+        }
     
     def get_lot_lineage(self, lot_no: str, max_depth: int = 10) -> Dict[str, Any]:
         """
-        Recursively trace lineage for a given lot number
+        Trace lineage for a given lot number
         Returns origin chain (where it came from) and destination chain (where it went)
+        
+        Results are memoized per (lot, max_depth) until the data is reloaded and are
+        shared between callers, so treat them as read-only
         """
-        print(f"\n=== Tracing lineage for Lot: {lot_no} ===")
+        self._info("=== Tracing lineage for Lot: %s ===", lot_no)
+        
+        cache_key = (lot_no, max_depth)
+        if cache_key in self._lineage_cache:
+            self._info("Using cached lineage")
+            return self._lineage_cache[cache_key]
+        
+        if self._lineage_graph is not None and lot_no in self.lot_index and max_depth >= 0:
+            result = self._compiled_lineage(lot_no, max_depth)
+            self._lineage_cache[cache_key] = result
+            return result
         
         visited_lots = set()
-        visited_prod_orders = set()
+        # Production orders already expanded, per direction: an order whose consumed
+        # lots were traced as origins still has its outputs to trace as destinations
+        visited_origin_orders = set()
+        visited_dest_orders = set()
         
-        def build_node(lot: str, depth: int, direction: str) -> Optional[Dict]:
-            """Recursively build lineage tree"""
+        def build_node(lot: str, depth: int) -> Optional[Dict]:
+            """Build the node for a lot, or None if it is too deep, visited or unknown"""
             if depth > max_depth or lot in visited_lots:
                 return None
             
             visited_lots.add(lot)
-            records = self.lot_index.get(lot, [])
-            
-            if not records:
+            if lot not in self.lot_index:
                 return None
             
             # Use first record for this lot
-            record = records[0]
-            
-            node = {
-                'lotNo': lot,
-                'prodOrderNo': record.get('Prod_ Order No_', ''),
-                'description': record.get('Description', ''),
-                'quantity': record.get('Quantity', 0),
-                'unit': record.get('Unit of Measure', ''),
-                'postingDate': str(record.get('Posting Date', '')),
-                'documentType': record.get('Document Type', ''),
-                'origins': [],
-                'destinations': [],
-                'depth': depth
-            }
+            return self._lineage_node(lot, depth)
+        
+        def linked_lots(node: Dict, direction: str):
+            """
+            Lazily yield (lot, direction, list key) for each related lot of a node;
+            lazy so visited checks see the subtrees of earlier siblings, as recursion would
+            """
+            lot = node['lotNo']
             
             # Trace origins (where this lot came from)
             if direction in ['origin', 'both']:
-                prod_order = str(record.get('Prod_ Order No_', '')).strip()
-                if prod_order and prod_order not in visited_prod_orders:
-                    visited_prod_orders.add(prod_order)
+                prod_order = node['prodOrderNo']
+                if prod_order in self.prod_order_index and prod_order not in visited_origin_orders:
+                    visited_origin_orders.add(prod_order)
                     
                     # Find consumption records for this production order
-                    consumption_records = self.prod_order_index.get(prod_order, [])
-                    for cons_rec in consumption_records:
-                        if cons_rec.get('Document Type') == 'Consumption':
-                            origin_lot = str(cons_rec.get('Lot No_', '')).strip()
-                            if origin_lot and origin_lot != lot:
-                                origin_node = build_node(origin_lot, depth + 1, 'origin')
-                                if origin_node:
-                                    node['origins'].append(origin_node)
+                    positions = self.prod_order_index[prod_order]
+                    consumption = self._document_type_codes.get('Consumption', -2)  # -2 matches no row
+                    for origin_lot in _lots_of_type(self._lots, self._lot_codes, self._document_types,
+                                                    positions, consumption):
+                        if origin_lot != lot:
+                            yield origin_lot, 'origin', 'origins'
             
             # Trace destinations (where this lot went to)
             if direction in ['destination', 'both']:
-                # Find production records where this lot was consumed
-                for prod_order, prod_records in self.prod_order_index.items():
-                    if prod_order in visited_prod_orders:
+                # Find production orders where this lot was consumed
+                for prod_order in self.consumed_lot_to_prod_orders.get(lot, []):
+                    if prod_order in visited_dest_orders:
                         continue
                     
-                    for prod_rec in prod_records:
-                        if prod_rec.get('Document Type') == 'Consumption':
-                            cons_lot = str(prod_rec.get('Lot No_', '')).strip()
-                            if cons_lot == lot:
-                                # Find output of this production order
-                                for output_rec in prod_records:
-                                    if output_rec.get('Document Type') == 'Output':
-                                        dest_lot = str(output_rec.get('Lot No_', '')).strip()
-                                        if dest_lot and dest_lot != lot:
-                                            visited_prod_orders.add(prod_order)
-                                            dest_node = build_node(dest_lot, depth + 1, 'destination')
-                                            if dest_node:
-                                                node['destinations'].append(dest_node)
+                    # Find output of this production order
+                    for dest_lot in self.prod_order_to_outputs.get(prod_order, []):
+                        if dest_lot != lot:
+                            yield dest_lot, 'destination', 'destinations'
+                    visited_dest_orders.add(prod_order)
+        
+        # Depth-first walk with an explicit stack of (node, pending related lots)
+        # instead of recursion, so deep chains never hit the recursion limit
+        lineage_tree = build_node(lot_no, 0)
+        stack = [(lineage_tree, linked_lots(lineage_tree, 'both'))] if lineage_tree else []
+        while stack:
+            node, pending = stack[-1]
+            link = next(pending, None)
+            if link is None:
+                stack.pop()
+                continue
             
-            return node
+            child_lot, child_direction, list_key = link
+            child = build_node(child_lot, node['depth'] + 1)
+            if child:
+                node[list_key].append(child)
+                stack.append((child, linked_lots(child, child_direction)))
         
-        lineage_tree = build_node(lot_no, 0, 'both')
-        
-        return {
+        result = {
             'queriedLot': lot_no,
             'lineageTree': lineage_tree,
             'totalNodesTraced': len(visited_lots)
         }
+        self._lineage_cache[cache_key] = result
+        return result
     
     def get_lot_statistics(self, lot_no: str) -> Dict[str, Any]:
         """Calculate statistics for a given lot"""
-        records = self.lot_index.get(lot_no, [])
-        
-        if not records:
+        if lot_no not in self.lot_index:
             return {'error': f'No records found for lot {lot_no}'}
         
-        total_quantity = sum(float(r.get('Quantity', 0)) for r in records)
+        stats = self.lot_stats.loc[lot_no]
         
         return {
             'lotNo': lot_no,
-            'totalRecords': len(records),
-            'totalQuantity': total_quantity,
-            'documentTypes': list(set(r.get('Document Type', '') for r in records)),
-            'postingDates': sorted(list(set(str(r.get('Posting Date', '')) for r in records))),
-            'units': list(set(r.get('Unit of Measure', '') for r in records))
+            'totalRecords': int(stats['totalRecords']),
+            'totalQuantity': float(stats['totalQuantity']),
+            'documentTypes': list(stats['documentTypes']),
+            'postingDates': list(stats['postingDates']),
+            'units': list(stats['units'])
         }
     
     def perform_inner_join(self, sheet1_key: str, sheet2_key: str, 
@@ -388,48 +910,57 @@ class CoffeeLotLineageTracker:
         Perform inner join between two sheets
         Example: Join production records with purchase records on matching lot numbers
         """
-        print(f"\n=== Performing Inner Join ===")
-        print(f"Joining {sheet1_key}.{join_column1} with {sheet2_key}.{join_column2}")
+        self._info("=== Performing Inner Join ===")
+        self._info("Joining %s.%s with %s.%s", sheet1_key, join_column1, sheet2_key, join_column2)
         
         # Get datasets
-        dataset1 = self.records if sheet1_key == 'main' else getattr(self, sheet1_key, [])
-        dataset2 = getattr(self, sheet2_key, [])
-        
-        # Create lookup from dataset2
-        lookup = {}
-        for record in dataset2:
-            key = str(record.get(join_column2, '')).strip()
-            if key:
-                if key not in lookup:
-                    lookup[key] = []
-                lookup[key].append(record)
-        
-        # Perform join
-        joined_results = []
-        for record1 in dataset1:
-            key = str(record1.get(join_column1, '')).strip()
-            if key and key in lookup:
-                for record2 in lookup[key]:
-                    # Merge both records
-                    joined_record = {**record1}
-                    for k, v in record2.items():
-                        joined_record[f"{sheet2_key}_{k}"] = v
-                    joined_results.append(joined_record)
-        
-        print(f"Inner join produced {len(joined_results)} results")
+        sheet1 = self._sheet(sheet1_key)
+        sheet2 = self._sheet(sheet2_key)
+        
+        # Hash join of row positions on the stripped keys (blank keys never match)
+        left = pd.DataFrame({'_key': _join_keys(sheet1, join_column1), '_left': np.arange(len(sheet1))})
+        right = pd.DataFrame({'_key': _join_keys(sheet2, join_column2), '_right': np.arange(len(sheet2))})
+        pairs = left[left['_key'] != ''].merge(right[right['_key'] != ''], on='_key', how='inner', sort=False)
+        
+        # Each sheet's rows are read once as tuples from whole-column value lists, and a
+        # record is built per matched pair (sheet2's columns prefixed with its key),
+        # rather than converting every cell of a joined frame
+        def row_tuples(sheet: pd.DataFrame) -> List[tuple]:
+            return list(zip(*(_row_values(sheet[column]) for column in sheet.columns)))
+        
+        columns = list(sheet1.columns) + [f"{sheet2_key}_{column}" for column in sheet2.columns]
+        with _gc_paused():
+            rows1 = row_tuples(sheet1)
+            rows2 = row_tuples(sheet2)
+            joined_results = [dict(zip(columns, rows1[i] + rows2[j]))
+                              for i, j in zip(pairs['_left'].tolist(), pairs['_right'].tolist())]
+        
+        self._info("Inner join produced %s results", len(joined_results))
         return joined_results
     
+    def _sheet(self, sheet_key: str) -> pd.DataFrame:
+        """Return a loaded sheet by attribute name ('main' is the consumption sheet)"""
+        sheet = self.records_df if sheet_key == 'main' else getattr(self, sheet_key, None)
+        return sheet if isinstance(sheet, pd.DataFrame) else pd.DataFrame()
+    
     def export_results(self, output_file: str, data: Any):
-        """Export results to JSON file"""
-        with open(output_file, 'w') as f:
-            json.dump(data, f, indent=2, default=str)
-        print(f"\nResults exported to {output_file}")
+        """Export results to JSON file (orjson when installed, stdlib json otherwise)"""
+        if orjson is not None:
+            with open(output_file, 'wb') as f:
+                f.write(orjson.dumps(data, default=str,
+                                     option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS))
+        else:
+            with open(output_file, 'w') as f:
+                json.dump(data, f, indent=2, default=str)
+        self._info("Results exported to %s", output_file)
 
 
 # Example usage
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    
     # Initialize tracker
-    tracker = CoffeeLotLineageTracker()
+    tracker = CoffeeLotLineageTracker(verbose=True)
     
     # Load Excel file
     excel_file_path = "test-data.xlsx"  # Change this to your file path
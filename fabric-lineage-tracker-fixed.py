@@ -1,15 +1,70 @@
 # ========== CELL 1: Fixed Lineage Tracker Class ==========
 import json
+from collections import namedtuple
 from datetime import datetime, timedelta
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_bytes(data, pretty=True):
+    """UTF-8 encoded JSON of data, serialized once (orjson when installed, stdlib json otherwise)"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+        return orjson.dumps(data, option=option)
+    return json.dumps(data, indent=2 if pretty else None, ensure_ascii=False).encode('utf-8')
+
+
+# Memoized node contents and related lots of a lot, see LotLineageTracker.expand_lot;
+# a tuple per lot rather than a dict, as the cache holds one for every lot traced
+LotExpansion = namedtuple('LotExpansion', ['process_types', 'details', 'is_origin', 'links'])
+
+
 class LotLineageTracker:
     """Recursive lineage tracker for coffee lots with complete bidirectional tracing."""
     
     def __init__(self, df_production):
         self.df_production = df_production
+        self.lot_expansion_cache = {}  # Lot -> node contents and related lots, see expand_lot
+        self._index_records()
+        print("✓ LotLineageTracker initialized")
+    
+    def _index_records(self):
+        """
+        Collect the production table to the driver once and index its records by lot
+        and by production order, plus production order -> consumed / output lots,
+        transfer destination lot -> transferred lots and lot -> stripped process types
+        """
         self.lot_records_cache = {}
         self.prod_order_cache = {}
-        print("✓ LotLineageTracker initialized")
+        self.process_types_of = {}
+        self.consumption_lots_of = {}
+        self.output_lots_of = {}
+        self.transfer_sources_of = {}
+        
+        for row in self.df_production.collect():
+            record = row.asDict()
+            lot = record.get('Lot No_')
+            prod_order = record.get('Prod_ Order No_')
+            if lot is not None:
+                self.lot_records_cache.setdefault(lot, []).append(record)
+                process_type = record.get('Process Type', 'Unknown')
+                types = self.process_types_of.setdefault(lot, set())
+                if process_type:
+                    types.add(str(process_type).strip())
+                dest_lot = record.get('Lot Dest')
+                if record.get('Process Type') == 'Transfer' and dest_lot is not None and dest_lot != lot:
+                    self.transfer_sources_of.setdefault(dest_lot, []).append(lot)
+            if prod_order is None:
+                continue
+            
+            self.prod_order_cache.setdefault(prod_order, []).append(record)
+            if lot is not None and record.get('Process Type') == 'Consumption':
+                self.consumption_lots_of.setdefault(prod_order, set()).add(lot)
+            elif lot is not None and record.get('Process Type') == 'Output':
+                self.output_lots_of.setdefault(prod_order, set()).add(lot)
     
     def parse_excel_date(self, date_value):
         if date_value is None or date_value == '':
@@ -26,36 +81,130 @@ class LotLineageTracker:
             return str(date_value)
     
     def get_lot_records(self, lot_no):
-        if lot_no in self.lot_records_cache:
-            return self.lot_records_cache[lot_no]
-        records = self.df_production.filter(self.df_production["Lot No_"] == lot_no).collect()
-        result = [row.asDict() for row in records]
-        self.lot_records_cache[lot_no] = result
-        return result
+        return self.lot_records_cache.get(lot_no, [])
     
     def get_prod_order_records(self, prod_order):
-        if prod_order in self.prod_order_cache:
-            return self.prod_order_cache[prod_order]
-        records = self.df_production.filter(self.df_production["Prod_ Order No_"] == prod_order).collect()
-        result = [row.asDict() for row in records]
-        self.prod_order_cache[prod_order] = result
-        return result
+        return self.prod_order_cache.get(prod_order, [])
     
     def get_process_types_for_lot(self, lot):
+        types = self.process_types_of.get(lot)
+        if types is None:
+            return ['Not Found']
+        return list(types) if types else ['Unknown']
+    
+    def expand_lot(self, lot):
+        """
+        Node contents of a lot (process types, details, origin flag) and its related lots
+        as (lot, relationship, list key) in a LotExpansion, or None when the lot has no records.
+        Memoized across traces: unlike a traced subtree, which depends on what the
+        trace visited before and how deep it is, these only depend on the lot's records
+        """
+        if lot in self.lot_expansion_cache:
+            return self.lot_expansion_cache[lot]
+        
         lot_data = self.get_lot_records(lot)
+        
+        # Handle not found
         if not lot_data:
-            return ['Not Found']
-        types = set()
+            self.lot_expansion_cache[lot] = None
+            return None
+        
+        # Group records by process type
+        processes = {}
         for record in lot_data:
-            process_type = record.get('Process Type', 'Unknown')
-            if process_type:
-                types.add(str(process_type).strip())
-        return list(types) if types else ['Unknown']
+            process_type = record.get('Process Type') or 'Unknown'
+            if process_type not in processes:
+                processes[process_type] = []
+            processes[process_type].append(record)
+        
+        # Add basic details
+        first = lot_data[0]
+        details = {
+            'item_no': first.get('Item No_', ''),
+            'description': first.get('Description', ''),
+            'certified': first.get('Certified', ''),
+            'unit_of_measure': first.get('Unit of Measure', 'KG'),
+            'location_code': first.get('Location Code', ''),
+            'counterparty': first.get('Counterparty', '')
+        }
+        links = []
+        
+        # ===== HANDLE OUTPUT PROCESS =====
+        # This lot was produced (Output) by consuming other lots
+        # Find SOURCES: What was consumed to make this lot?
+        if 'Output' in processes:
+            for output_record in processes['Output']:
+                prod_order = output_record.get('Prod_ Order No_')
+                if prod_order:
+                    details['production_order'] = prod_order
+                    details['output_quantity'] = output_record.get('Quantity (Inv_UoM)', 0)
+                    details['output_date'] = self.parse_excel_date(output_record.get('Date'))
+                    
+                    # Find all CONSUMPTION lots in the same production order
+                    consumption_lots = self.consumption_lots_of.get(prod_order, set()) - {lot}
+                    
+                    # Trace each consumed lot as a SOURCE
+                    for consumed_lot in consumption_lots:
+                        if consumed_lot:
+                            links.append((consumed_lot, 'Consumed to produce this lot', 'sources'))
+        
+        # ===== HANDLE CONSUMPTION PROCESS =====
+        # This lot was consumed (Consumption) to produce other lots
+        # Find DESTINATIONS: What was produced by consuming this lot?
+        if 'Consumption' in processes:
+            for consumption_record in processes['Consumption']:
+                prod_order = consumption_record.get('Prod_ Order No_')
+                if prod_order:
+                    details['consumption_quantity'] = consumption_record.get('Quantity (Inv_UoM)', 0)
+                    details['consumption_date'] = self.parse_excel_date(consumption_record.get('Date'))
+                    
+                    # Find all OUTPUT lots in the same production order
+                    output_lots = self.output_lots_of.get(prod_order, set()) - {lot}
+                    
+                    # Trace each output lot as a DESTINATION
+                    for output_lot in output_lots:
+                        if output_lot:
+                            links.append((output_lot, 'Produced by consuming this lot', 'destinations'))
+        
+        # ===== HANDLE TRANSFER PROCESS =====
+        # This lot was transferred
+        if 'Transfer' in processes:
+            for transfer_record in processes['Transfer']:
+                dest_lot = transfer_record.get('Lot Dest')
+                details['transfer'] = {
+                    'transfer_quantity': transfer_record.get('Quantity (Inv_UoM)', 0),
+                    'transfer_date': self.parse_excel_date(transfer_record.get('Date')),
+                    'transferred_to': dest_lot
+                }
+                
+                # Find DESTINATION: Where this lot was transferred TO
+                if dest_lot and dest_lot != lot:
+                    links.append((dest_lot, 'Transferred to', 'destinations'))
+                
+                # Find SOURCE: Lots that were transferred to create this lot
+                for source_lot in self.transfer_sources_of.get(lot, ()):
+                    if source_lot:
+                        links.append((source_lot, 'Transferred from', 'sources'))
+        
+        # ===== HANDLE PURCHASE PROCESS =====
+        # This lot was purchased (origin point)
+        is_origin = 'Purchase' in processes
+        if is_origin:
+            purchase_record = processes['Purchase'][0]
+            details['purchase'] = {
+                'quantity': purchase_record.get('Quantity (Inv_UoM)', 0),
+                'date': self.parse_excel_date(purchase_record.get('Date'))
+            }
+        
+        expansion = LotExpansion(self.get_process_types_for_lot(lot), details, is_origin, links)
+        self.lot_expansion_cache[lot] = expansion
+        return expansion
     
     def get_lot_lineage(self, lot_no, max_depth=100):
         visited = set()
         
-        def trace_lot_origin(lot, depth=0):
+        def build_node(lot, depth):
+            """Build the node for a lot and an iterator over its related lots"""
             # Check termination conditions
             if lot in visited or depth >= max_depth:
                 return {
@@ -65,148 +214,52 @@ class LotLineageTracker:
                     'sources': [],
                     'destinations': [],
                     'details': {}
-                }
+                }, iter(())
             
             visited.add(lot)
-            lot_data = self.get_lot_records(lot)
+            expansion = self.expand_lot(lot)
             
             # Handle not found
-            if not lot_data:
+            if expansion is None:
                 return {
                     'lot_no': lot,
                     'process_types': ['Not Found'],
                     'sources': [],
                     'destinations': [],
                     'details': {}
-                }
-            
-            # Group records by process type
-            processes = {}
-            for record in lot_data:
-                process_type = record.get('Process Type') or 'Unknown'
-                if process_type not in processes:
-                    processes[process_type] = []
-                processes[process_type].append(record)
+                }, iter(())
             
-            # Initialize node structure
+            # Fresh node from the memoized contents (nested details are shared, read-only)
             node = {
                 'lot_no': lot,
-                'process_types': self.get_process_types_for_lot(lot),
+                'process_types': list(expansion.process_types),
                 'sources': [],
                 'destinations': [],
-                'details': {}
+                'details': dict(expansion.details)
             }
-            
-            # Add basic details
-            if lot_data:
-                first = lot_data[0]
-                node['details'] = {
-                    'item_no': first.get('Item No_', ''),
-                    'description': first.get('Description', ''),
-                    'certified': first.get('Certified', ''),
-                    'unit_of_measure': first.get('Unit of Measure', 'KG'),
-                    'location_code': first.get('Location Code', ''),
-                    'counterparty': first.get('Counterparty', '')
-                }
-            
-            # ===== HANDLE OUTPUT PROCESS =====
-            # This lot was produced (Output) by consuming other lots
-            # Find SOURCES: What was consumed to make this lot?
-            if 'Output' in processes:
-                for output_record in processes['Output']:
-                    prod_order = output_record.get('Prod_ Order No_')
-                    if prod_order:
-                        node['details']['production_order'] = prod_order
-                        node['details']['output_quantity'] = output_record.get('Quantity (Inv_UoM)', 0)
-                        node['details']['output_date'] = self.parse_excel_date(output_record.get('Date'))
-                        
-                        # Get all records in this production order
-                        prod_records = self.get_prod_order_records(prod_order)
-                        consumption_lots = set()
-                        
-                        # Find all CONSUMPTION lots in the same production order
-                        for record in prod_records:
-                            if record.get('Process Type') == 'Consumption' and record.get('Lot No_') != lot:
-                                consumption_lots.add(record.get('Lot No_'))
-                        
-                        # Recursively trace each consumed lot as a SOURCE
-                        for consumed_lot in consumption_lots:
-                            if consumed_lot:
-                                source_node = trace_lot_origin(consumed_lot, depth + 1)
-                                source_node['relationship'] = 'Consumed to produce this lot'
-                                node['sources'].append(source_node)
-            
-            # ===== HANDLE CONSUMPTION PROCESS =====
-            # This lot was consumed (Consumption) to produce other lots
-            # Find DESTINATIONS: What was produced by consuming this lot?
-            if 'Consumption' in processes:
-                for consumption_record in processes['Consumption']:
-                    prod_order = consumption_record.get('Prod_ Order No_')
-                    if prod_order:
-                        node['details']['consumption_quantity'] = consumption_record.get('Quantity (Inv_UoM)', 0)
-                        node['details']['consumption_date'] = self.parse_excel_date(consumption_record.get('Date'))
-                        
-                        # Get all records in this production order
-                        prod_records = self.get_prod_order_records(prod_order)
-                        output_lots = set()
-                        
-                        # Find all OUTPUT lots in the same production order
-                        for record in prod_records:
-                            if record.get('Process Type') == 'Output' and record.get('Lot No_') != lot:
-                                output_lots.add(record.get('Lot No_'))
-                        
-                        # Recursively trace each output lot as a DESTINATION
-                        for output_lot in output_lots:
-                            if output_lot:
-                                dest_node = trace_lot_origin(output_lot, depth + 1)
-                                dest_node['relationship'] = 'Produced by consuming this lot'
-                                node['destinations'].append(dest_node)
-            
-            # ===== HANDLE TRANSFER PROCESS =====
-            # This lot was transferred
-            if 'Transfer' in processes:
-                for transfer_record in processes['Transfer']:
-                    dest_lot = transfer_record.get('Lot Dest')
-                    node['details']['transfer'] = {
-                        'transfer_quantity': transfer_record.get('Quantity (Inv_UoM)', 0),
-                        'transfer_date': self.parse_excel_date(transfer_record.get('Date')),
-                        'transferred_to': dest_lot
-                    }
-                    
-                    # Find DESTINATION: Where this lot was transferred TO
-                    if dest_lot and dest_lot != lot:
-                        dest_node = trace_lot_origin(dest_lot, depth + 1)
-                        dest_node['relationship'] = 'Transferred to'
-                        node['destinations'].append(dest_node)
-                    
-                    # Find SOURCE: Lots that were transferred to create this lot
-                    source_transfers = self.df_production.filter(
-                        (self.df_production["Process Type"] == "Transfer") & 
-                        (self.df_production["Lot Dest"] == lot) &
-                        (self.df_production["Lot No_"] != lot)
-                    ).collect()
-                    
-                    for src_transfer in source_transfers:
-                        source_lot = src_transfer['Lot No_']
-                        if source_lot and source_lot != lot:
-                            source_node = trace_lot_origin(source_lot, depth + 1)
-                            source_node['relationship'] = 'Transferred from'
-                            node['sources'].append(source_node)
-            
-            # ===== HANDLE PURCHASE PROCESS =====
-            # This lot was purchased (origin point)
-            if 'Purchase' in processes:
-                purchase_record = processes['Purchase'][0]
-                node['details']['purchase'] = {
-                    'quantity': purchase_record.get('Quantity (Inv_UoM)', 0),
-                    'date': self.parse_excel_date(purchase_record.get('Date'))
-                }
+            if expansion.is_origin:
                 node['is_origin'] = True  # Mark as origin point
             
-            return node
+            return node, iter(expansion.links)
         
-        # Start the recursive trace
-        lineage_tree = trace_lot_origin(lot_no)
+        # Depth-first trace with an explicit stack of (node, depth, pending related lots,
+        # relationship to its parent) instead of recursion, so max_depth is not bounded
+        # by the interpreter's recursion limit
+        lineage_tree, related = build_node(lot_no, 0)
+        stack = [(lineage_tree, 0, related, None)]
+        while stack:
+            node, depth, pending, relationship = stack[-1]
+            link = next(pending, None)
+            if link is None:
+                stack.pop()
+                if relationship:
+                    node['relationship'] = relationship
+                continue
+            
+            child_lot, child_relationship, list_key = link
+            child, child_related = build_node(child_lot, depth + 1)
+            node[list_key].append(child)
+            stack.append((child, depth + 1, child_related, child_relationship))
         
         return {
             'query_lot': lot_no,
@@ -217,12 +270,15 @@ class LotLineageTracker:
     def get_lineage_as_json(self, lot_no, max_depth=100, pretty=True):
         """Get lineage as JSON string"""
         lineage = self.get_lot_lineage(lot_no, max_depth)
-        if pretty:
-            return json.dumps(lineage, indent=2, ensure_ascii=False)
-        return json.dumps(lineage, ensure_ascii=False)
+        return json_bytes(lineage, pretty).decode('utf-8')
     
     def trace_multiple_lots(self, lot_numbers, max_depth=100):
-        """Trace lineage for multiple lots with progress tracking"""
+        """
+        Trace lineage for multiple lots with progress tracking
+        
+        Serial on purpose: expand_lot is memoized, so after the first lots most of the
+        graph is cached and each further lot costs little
+        """
         results = {}
         total = len(lot_numbers)
         for i, lot_no in enumerate(lot_numbers, 1):
@@ -232,9 +288,9 @@ class LotLineageTracker:
         return results
     
     def clear_cache(self):
-        """Clear all caches"""
-        self.lot_records_cache.clear()
-        self.prod_order_cache.clear()
+        """Clear all caches and re-collect the record indexes from df_production"""
+        self.lot_expansion_cache.clear()
+        self._index_records()
         print("✓ Cache cleared")
 
 
@@ -294,19 +350,20 @@ final_output = {
     'lineage_traces': all_lineages
 }
 
-json_output = json.dumps(final_output, indent=2, ensure_ascii=False)
+# Serialized once; the size comes from the encoded bytes
+json_output = json_bytes(final_output)
 
 print("\n" + "="*80)
 print("🎉 COMPLETE - BIDIRECTIONAL LINEAGE TRACING")
 print("="*80)
 print(f"\n✓ Total consumption lots: {len(all_lineages)}")
 print(f"✓ Total related lots: {total_lots}")
-print(f"✓ JSON size: {len(json_output.encode('utf-8')) / 1024:.2f} KB")
+print(f"✓ JSON size: {len(json_output) / 1024:.2f} KB")
 print("\n" + "="*80)
 print("📥 COPY JSON BELOW")
 print("="*80 + "\n")
 
-print(json_output)
+print(json_output.decode('utf-8'))
 
 print("\n" + "="*80)
 print("📥 END OF JSON")
@@ -4,12 +4,36 @@
 
 import json
 import time
-from pyspark.sql import SparkSession
-from pyspark.sql.functions import col, collect_list, struct, lit, count, sum as spark_sum, max as spark_max
+from functools import reduce
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql.types import IntegralType
+from pyspark.sql.functions import col, lit, count, countDistinct, when, concat, array, array_join, array_contains, broadcast, sum as spark_sum, max as spark_max
 from datetime import datetime
 
-# Initialize Spark session
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from graphframes import GraphFrame
+except ImportError:
+    GraphFrame = None
+
+# Initialize Spark session; results are collected to the driver through Arrow
 spark = SparkSession.builder.appName("CoffeeLotLineage").getOrCreate()
+spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+
+# Adaptive Query Execution: re-plan joins from runtime shuffle statistics, split the
+# skewed prod_order_no partitions (a few orders consume hundreds of lots) and coalesce
+# the small ones
+spark.conf.set("spark.sql.adaptive.enabled", "true")
+spark.conf.set("spark.sql.adaptive.skewJoin.enabled", "true")
+spark.conf.set("spark.sql.adaptive.coalescePartitions.enabled", "true")
+spark.conf.set("spark.sql.adaptive.localShuffleReader.enabled", "true")
+
+# Print diagnostics that each cost an extra Spark job (intermediate join counts)
+DEBUG = False
 
 print("=" * 80)
 print("Coffee Lot Lineage Tracker - Fabric Lakehouse Implementation")
@@ -93,10 +117,21 @@ except:
 
 load_time = time.time() - start_time
 print(f"✓ Loaded all tables in {load_time:.2f} seconds")
-print(f"  - Production/Consumption records: {df_production.count():,}")
-print(f"  - Purchase records: {df_purchase.count():,}")
-print(f"  - Sale records: {df_sale.count():,}")
-print(f"  - EACL records: {df_eacl.count():,}")
+
+# Count all four tables in a single Spark job rather than one job per count()
+table_counts = {
+    row["table"]: row["count"]
+    for row in df_production.select(lit("production").alias("table"))
+    .unionByName(df_purchase.select(lit("purchase").alias("table")))
+    .unionByName(df_sale.select(lit("sale").alias("table")))
+    .unionByName(df_eacl.select(lit("eacl").alias("table")))
+    .groupBy("table").count()
+    .collect()
+}
+print(f"  - Production/Consumption records: {table_counts.get('production', 0):,}")
+print(f"  - Purchase records: {table_counts.get('purchase', 0):,}")
+print(f"  - Sale records: {table_counts.get('sale', 0):,}")
+print(f"  - EACL records: {table_counts.get('eacl', 0):,}")
 
 # ============================================================================
 # STEP 2: Perform VLOOKUP (LEFT JOIN Purchase Data into Production)
@@ -105,8 +140,11 @@ print("\n[STEP 2] Performing VLOOKUP (Purchase -> Production)...")
 start_time = time.time()
 
 # This replicates: performPurchaseVLOOKUP() from excelParser.ts
+# The purchase table is small: project it to the looked-up columns and broadcast it,
+# so the production table is joined in place instead of shuffled and sorted
+df_purchase_lookup = df_purchase.select("lot_no", "supplier", "origin", "purchase_date", "price")
 df_enriched = df_production.alias("prod").join(
-    df_purchase.alias("purch"),
+    broadcast(df_purchase_lookup).alias("purch"),
     col("prod.lot_no") == col("purch.lot_no"),
     "left"
 ).select(
@@ -118,16 +156,22 @@ df_enriched = df_production.alias("prod").join(
 )
 
 vlookup_time = time.time() - start_time
-enriched_count = df_enriched.count()
-matched_count = df_enriched.filter(col("vlookup_supplier").isNotNull()).count()
+
+# Cache enriched data for performance; the counts below are the action that fills it
+df_enriched.cache()
+
+# Total and matched records in one Spark job (count of a column skips nulls)
+enrich_stats = df_enriched.agg(
+    count(lit(1)).alias("total"),
+    count(col("vlookup_supplier")).alias("matched")
+).collect()[0]
+enriched_count = enrich_stats["total"]
+matched_count = enrich_stats["matched"]
 
 print(f"✓ VLOOKUP completed in {vlookup_time:.2f} seconds")
 print(f"  - Total records: {enriched_count:,}")
 print(f"  - Matched with purchase data: {matched_count:,} ({matched_count/enriched_count*100:.1f}%)")
 
-# Cache enriched data for performance
-df_enriched.cache()
-
 # ============================================================================
 # STEP 3: Build Purchase Lot Mapping (5-Step Inner Join)
 # ============================================================================
@@ -137,20 +181,22 @@ start_time = time.time()
 # This replicates: buildPurchaseLotMapping() from excelParser.ts
 # Join sequence:
 # EACL Navision -> Nav Transform -> Nav Bridge -> Production Results -> Production Consumption
-
-df_step1 = df_eacl.join(df_transform, "document_no", "inner")
-step1_count = df_step1.count()
-print(f"  Step 1: EACL -> Transform = {step1_count:,} records")
-
-df_step2 = df_step1.join(df_bridge, "transform_key", "inner")
-step2_count = df_step2.count()
-print(f"  Step 2: Transform -> Bridge = {step2_count:,} records")
-
-df_step3 = df_step2.join(df_results, "bridge_key", "inner")
-step3_count = df_step3.count()
-print(f"  Step 3: Bridge -> Results = {step3_count:,} records")
-
-df_purchase_mapping = df_step3.join(
+# Transform, Bridge and Results are small lookup tables: broadcast them explicitly so the
+# chain runs as map-side hash joins (automatic broadcast selection does not always apply)
+
+df_step1 = df_eacl.join(broadcast(df_transform), "document_no", "inner")
+df_step2 = df_step1.join(broadcast(df_bridge), "transform_key", "inner")
+df_step3 = df_step2.join(broadcast(df_results), "bridge_key", "inner")
+
+# Each intermediate count re-runs the chain up to that step, so they are debug-only
+if DEBUG:
+    print(f"  Step 1: EACL -> Transform = {df_step1.count():,} records")
+    print(f"  Step 2: Transform -> Bridge = {df_step2.count():,} records")
+    print(f"  Step 3: Bridge -> Results = {df_step3.count():,} records")
+
+# The joined lookup chain is the small side against the production table: hint it as
+# the hash join's build side, while df_enriched is only probed and never hashed
+df_purchase_mapping = df_step3.hint("shuffle_hash").join(
     df_enriched.select("prod_order_no", "lot_no", "quantity", "posting_date", "entry_type"),
     "prod_order_no",
     "inner"
@@ -166,223 +212,342 @@ df_purchase_mapping = df_step3.join(
     col("bridge_key")
 )
 
+# Materialize purchase mapping with a local checkpoint (the one action that runs the join
+# chain), so STEP 6's queries on it start from the stored rows rather than the join plan
+df_purchase_mapping = df_purchase_mapping.localCheckpoint(eager=True)
 step4_count = df_purchase_mapping.count()
 print(f"  Step 4: Results -> Production = {step4_count:,} records")
 
 join_time = time.time() - start_time
 print(f"✓ 5-step join completed in {join_time:.2f} seconds")
 
-# Cache purchase mapping
-df_purchase_mapping.cache()
-
 # Get unique sale contracts
-sale_contracts = df_purchase_mapping.select("sale_contract").distinct().rdd.flatMap(lambda x: x).collect()
+sale_contracts = [row.sale_contract for row in df_purchase_mapping.select("sale_contract").distinct().collect()]
 print(f"  - Total unique sale contracts: {len(sale_contracts):,}")
 
 # ============================================================================
-# STEP 4: Recursive Lineage Tracing Function
+# STEP 4: Iterative Lineage Tracing Function
 # ============================================================================
-print("\n[STEP 4] Setting up recursive lineage tracing...")
+print("\n[STEP 4] Setting up iterative lineage tracing...")
+
+# Columns of a lineage row, taken from df_enriched (the VLOOKUP columns renamed)
+LINEAGE_COLUMNS = [
+    "lot_no", "lot_code", "prod_order_no", "item_no", "description", "quantity",
+    "unit_of_measure", "entry_type", "posting_date", "document_type", "location_code",
+    col("vlookup_supplier").alias("supplier"),
+    col("vlookup_origin").alias("origin"),
+    col("vlookup_purchase_date").alias("purchase_date")
+]
+
+# Lineage result fields (JSON key -> lineage column) of origin, destination and detail rows
+ORIGIN_FIELDS = {
+    "lotNo": "lot_no", "lotCode": "lot_code", "itemNo": "item_no", "description": "description",
+    "quantity": "quantity", "unitOfMeasure": "unit_of_measure", "entryType": "entry_type",
+    "postingDate": "posting_date", "documentType": "document_type", "locationCode": "location_code",
+    "supplier": "supplier", "supplierOrigin": "origin", "purchaseDate": "purchase_date",
+    "depth": "depth", "path": "path"
+}
+DESTINATION_FIELDS = {
+    "lotNo": "lot_no", "lotCode": "lot_code", "itemNo": "item_no", "description": "description",
+    "quantity": "quantity", "unitOfMeasure": "unit_of_measure", "entryType": "entry_type",
+    "postingDate": "posting_date", "documentType": "document_type", "depth": "depth", "path": "path"
+}
+DETAIL_FIELDS = {
+    "lotNo": "lot_no", "prodOrderNo": "prod_order_no", "itemNo": "item_no", "description": "description",
+    "quantity": "quantity", "entryType": "entry_type", "postingDate": "posting_date",
+    "supplier": "supplier", "origin": "origin"
+}
 
-def trace_lot_lineage(lot_no, max_depth=10):
+# The lineage's inputs, defined once and shared by every trace. The lineage only reads
+# LINEAGE_COLUMNS, so that projection is materialized on its own from df_enriched's
+# cache, which is then released: every later scan reads the narrow copy instead of the
+# full enriched width. A local checkpoint rather than a cache, so the plans built on it
+# start from a leaf instead of carrying the load and VLOOKUP history into every level
+df_lineage_source = df_enriched.select(*LINEAGE_COLUMNS).localCheckpoint(eager=True)
+df_enriched.unpersist()
+
+# Consumption and Output rows, read by every lineage level: cached once each so no level
+# re-filters the lineage source on entry_type, and partitioned by production order, the
+# key of the per-level joins. Only these rows are partitioned on it, and only those with
+# an order: rows without one (purchases, transfers) never match a join on the order and
+# would otherwise all hash into a single partition
+df_consumption = df_lineage_source.filter(
+    (col("entry_type") == "Consumption") & col("prod_order_no").isNotNull()
+).repartition("prod_order_no").cache()
+df_output = df_lineage_source.filter(
+    (col("entry_type") == "Output") & col("prod_order_no").isNotNull()
+).repartition("prod_order_no").cache()
+df_consumption.count()
+df_output.count()
+
+# Consumed lot -> destination rows: the Output rows of every production order consuming
+# the lot (other than the lot itself), joined once so each lineage level finds a lot's
+# destinations with a single join. Keyed on the lot: partitioned by lot and cached once
+df_lot_destinations = df_consumption.select(
+    col("lot_no").alias("consumed_lot"),
+    col("prod_order_no").alias("consuming_order")
+).join(
+    df_output,
+    (col("prod_order_no") == col("consuming_order")) & (col("lot_no") != col("consumed_lot"))
+).repartition("consumed_lot").cache()
+
+# (lot, production order) edge list of the lineage graph: small and cached, it finds the
+# part of the graph a trace can reach before any lineage join runs
+df_lot_orders = df_lineage_source.select("lot_no", "prod_order_no").distinct().cache()
+
+# Traces deeper than this find their reachable orders from the connected components of
+# the lineage graph (with GraphFrames installed) rather than a search hop by hop
+COMPONENT_LOOKUP_DEPTH = 10
+df_edge_components = None
+
+def edge_components():
     """
-    Recursively trace lot lineage using Spark SQL
-    Replicates: getLotLineage() from excelParser.ts
+    Connected component of every (lot, order) edge, computed with GraphFrames on first
+    use and cached for the later deep traces. Lots and orders are vertices of one graph,
+    told apart by prefix. connectedComponents() checkpoints to a directory the
+    executors resolve, the lakehouse Files area (not the driver's /lakehouse/default mount)
     """
+    global df_edge_components
+    if df_edge_components is None:
+        print("  Computing lineage graph components (GraphFrames)...")
+        spark.sparkContext.setCheckpointDir("Files/_checkpoints")
+        lineage_edges = df_lot_orders.filter(
+            col("lot_no").isNotNull() & col("prod_order_no").isNotNull()
+        ).select(
+            "lot_no",
+            "prod_order_no",
+            concat(lit("lot:"), col("lot_no").cast("string")).alias("src"),
+            concat(lit("order:"), col("prod_order_no").cast("string")).alias("dst")
+        )
+        lineage_vertices = lineage_edges.select(col("src").alias("id")).unionByName(
+            lineage_edges.select(col("dst").alias("id"))
+        ).distinct()
+        lineage_components = GraphFrame(lineage_vertices, lineage_edges).connectedComponents()
+        df_edge_components = lineage_edges.join(
+            lineage_components.select(col("id").alias("src"), "component"), "src"
+        ).select("lot_no", "prod_order_no", "component").cache()
+    return df_edge_components
+
+def find_reachable_orders(lot_nos, max_depth):
+    """
+    Production orders within max_depth lineage levels of the given lots
     
-    # Register temp view for enriched data
-    df_enriched.createOrReplaceTempView("production_enriched")
+    Breadth-first search over the (lot, order) edge list: every lineage level steps
+    from a lot to its production orders and from those to their lots, so all rows a
+    trace can reach below level 0 belong to the orders found here. Each hop is one
+    small Spark job; the search stops early once no new lots are found.
+    Beyond COMPONENT_LOOKUP_DEPTH (and with GraphFrames installed) the orders of the
+    lots' whole connected components are returned instead, in one Spark job
+    """
+    if max_depth > COMPONENT_LOOKUP_DEPTH and GraphFrame is not None:
+        components = edge_components()
+        seed_components = components.filter(col("lot_no").isin(list(lot_nos))).select(
+            "component"
+        ).distinct()
+        return {
+            row.prod_order_no
+            for row in components.join(broadcast(seed_components), "component")
+            .select("prod_order_no").distinct().collect()
+        }
+    
+    reached_lots = set(lot_nos)
+    reached_orders = set()
+    frontier_lots = set(lot_nos)
+    for _ in range(max_depth):
+        if not frontier_lots:
+            break
+        hop = df_lot_orders.filter(col("lot_no").isin(list(frontier_lots))).select(
+            "prod_order_no"
+        ).distinct().join(df_lot_orders, "prod_order_no").collect()
+        reached_orders.update(row.prod_order_no for row in hop)
+        frontier_lots = {row.lot_no for row in hop} - reached_lots
+        reached_lots |= frontier_lots
+    return reached_orders
+
+def lineage_rows(seeds, max_depth, consumption=df_consumption, lot_destinations=df_lot_destinations):
+    """
+    Lineage rows of the seed lots (a DataFrame of seed_lot), level by level with
+    DataFrame self-joins
+    
+    Each level holds the rows one step further from the seed lots: origins are the
+    other lots consumed in a level row's production order, destinations the other
+    output lots of the orders consuming a level row's lot. Every row carries the seed
+    lot it descends from (seed_lot), so one join per level serves all lots. The loop
+    stops at max_depth or at the first empty level. A row is never extended to a lot
+    already on its path, so rework loops end instead of repeating to max_depth
     
-    # Recursive CTE query
-    recursive_query = f"""
-    WITH RECURSIVE lineage AS (
-        -- Base case: Start with the queried lot
-        SELECT 
-            lot_no,
-            lot_code,
-            prod_order_no,
-            item_no,
-            description,
-            quantity,
-            unit_of_measure,
-            entry_type,
-            posting_date,
-            document_type,
-            location_code,
-            vlookup_supplier as supplier,
-            vlookup_origin as origin,
-            vlookup_purchase_date as purchase_date,
-            0 as depth,
-            lot_no as path,
-            'current' as relationship_type
-        FROM production_enriched
-        WHERE lot_no = '{lot_no}'
+    Returns the levels' rows unioned: seed_lot, the lineage source columns, depth, path
+    (array of lots) and relationship_type
+    """
+    def as_level(rows, depth, path, relationship_type):
+        return rows.select(
+            "seed_lot",
+            *df_lineage_source.columns,
+            lit(depth).alias("depth"),
+            path.alias("path"),
+            lit(relationship_type).alias("relationship_type")
+        )
+    
+    # Level 0: the seed lots' own records
+    level = as_level(
+        df_lineage_source.join(seeds, col("lot_no") == col("seed_lot")),
+        0, array(col("lot_no")), "current"
+    )
+    levels = [level]
+    
+    for depth in range(1, max_depth + 1):
+        frontier = level.select(
+            "seed_lot",
+            col("lot_no").alias("from_lot"),
+            col("prod_order_no").alias("from_order"),
+            col("path").alias("from_path")
+        )
         
-        UNION ALL
+        # The path is kept as an array of lots and only joined into text at collect time
+        path = concat(col("from_path"), array(col("lot_no")))
         
-        -- Recursive case 1: Find origins (consumed inputs in same production order)
-        SELECT 
-            pe.lot_no,
-            pe.lot_code,
-            pe.prod_order_no,
-            pe.item_no,
-            pe.description,
-            pe.quantity,
-            pe.unit_of_measure,
-            pe.entry_type,
-            pe.posting_date,
-            pe.document_type,
-            pe.location_code,
-            pe.vlookup_supplier,
-            pe.vlookup_origin,
-            pe.vlookup_purchase_date,
-            l.depth + 1,
-            CONCAT(l.path, ' -> ', pe.lot_no),
-            'origin'
-        FROM lineage l
-        INNER JOIN production_enriched pe 
-            ON l.prod_order_no = pe.prod_order_no 
-            AND pe.entry_type = 'Consumption'
-            AND pe.lot_no != l.lot_no
-        WHERE l.depth < {max_depth}
+        # Cycle guard: skip lots already on the row's path (its last lot is from_lot)
+        off_path = ~array_contains(col("from_path"), col("lot_no"))
         
-        UNION ALL
+        # Origins: consumed inputs in the same production order
+        origins = frontier.join(
+            consumption,
+            (col("prod_order_no") == col("from_order")) & off_path
+        )
         
-        -- Recursive case 2: Find destinations (where this lot was consumed)
-        SELECT 
-            pe2.lot_no,
-            pe2.lot_code,
-            pe2.prod_order_no,
-            pe2.item_no,
-            pe2.description,
-            pe2.quantity,
-            pe2.unit_of_measure,
-            pe2.entry_type,
-            pe2.posting_date,
-            pe2.document_type,
-            pe2.location_code,
-            pe2.vlookup_supplier,
-            pe2.vlookup_origin,
-            pe2.vlookup_purchase_date,
-            l.depth + 1,
-            CONCAT(l.path, ' -> ', pe2.lot_no),
-            'destination'
-        FROM lineage l
-        INNER JOIN production_enriched pe1 
-            ON l.lot_no = pe1.lot_no 
-            AND pe1.entry_type = 'Consumption'
-        INNER JOIN production_enriched pe2 
-            ON pe1.prod_order_no = pe2.prod_order_no 
-            AND pe2.entry_type = 'Output'
-            AND pe2.lot_no != l.lot_no
-        WHERE l.depth < {max_depth}
-    )
-    SELECT * FROM lineage
+        # Destinations: outputs of the production orders where this lot was consumed
+        destinations = frontier.join(
+            lot_destinations,
+            (col("consumed_lot") == col("from_lot")) & off_path
+        )
+        
+        # Materialize the level (truncating its plan) so the next level starts from it
+        level = as_level(origins, depth, path, "origin").unionByName(
+            as_level(destinations, depth, path, "destination")
+        ).localCheckpoint()
+        if level.isEmpty():
+            break
+        levels.append(level)
+    
+    return reduce(DataFrame.unionByName, levels)
+
+def lineage_key(lot_no):
+    """Key of a queried lot in trace_lots_lineage's results: its text, None for no lot"""
+    return None if lot_no is None else str(lot_no)
+
+def trace_lots_lineage(lot_nos, max_depth=10):
     """
+    Trace the lineage of several lots together
+    Replicates: getLotLineage() from excelParser.ts, for each lot
     
-    # Execute recursive query
-    df_lineage = spark.sql(recursive_query)
+    The lots are traced together by lineage_rows, with the joins only reading the
+    production orders reachable from the queried lots (find_reachable_orders) rather
+    than the whole enriched table. The lineage rows are collected once and split per
+    queried lot
     
-    # Separate by relationship type
-    df_current = df_lineage.filter(col("relationship_type") == "current")
-    df_origins = df_lineage.filter(col("relationship_type") == "origin")
-    df_destinations = df_lineage.filter(col("relationship_type") == "destination")
+    Returns queried lot (lineage_key) -> lineage result
+    """
+    # Lots are keyed and seeded by their text, the seed column's type, whatever the
+    # type of lot_no; a missing lot (None) has no records and gets an empty trace
+    lot_keys = list(dict.fromkeys(lineage_key(lot_no) for lot_no in lot_nos))
+    seed_lots = [key for key in lot_keys if key is not None]
+    if not seed_lots:
+        return {key: build_lineage_result(key, {}, None) for key in lot_keys}
     
-    # Build JSON structure
-    result = {
-        "queriedLot": lot_no,
-        "lineageTree": {
-            "lotNo": lot_no,
-            "origins": [],
-            "destinations": [],
-            "details": []
-        },
-        "statistics": {}
-    }
+    # The lots come in as data (a seed DataFrame) rather than spliced into a query, so
+    # they are never parsed as SQL and every call plans the same joins
+    seeds = spark.createDataFrame([(lot,) for lot in seed_lots], "seed_lot string")
     
-    # Collect origins
-    origins_data = df_origins.collect()
-    result["lineageTree"]["origins"] = [
-        {
-            "lotNo": row.lot_no,
-            "lotCode": row.lot_code,
-            "itemNo": row.item_no,
-            "description": row.description,
-            "quantity": float(row.quantity) if row.quantity else 0,
-            "unitOfMeasure": row.unit_of_measure,
-            "entryType": row.entry_type,
-            "postingDate": str(row.posting_date) if row.posting_date else None,
-            "documentType": row.document_type,
-            "locationCode": row.location_code,
-            "supplier": row.supplier,
-            "supplierOrigin": row.origin,
-            "purchaseDate": str(row.purchase_date) if row.purchase_date else None,
-            "depth": row.depth,
-            "path": row.path
-        }
-        for row in origins_data
-    ]
+    # Restrict the per-level join inputs to the part of the graph the lots can reach
+    reachable_orders = list(find_reachable_orders(seed_lots, max_depth))
+    df_lineage = lineage_rows(
+        broadcast(seeds),
+        max_depth,
+        df_consumption.filter(col("prod_order_no").isin(reachable_orders)),
+        df_lot_destinations.filter(col("consuming_order").isin(reachable_orders))
+    ).cache()
     
-    # Collect destinations
-    destinations_data = df_destinations.collect()
-    result["lineageTree"]["destinations"] = [
-        {
-            "lotNo": row.lot_no,
-            "lotCode": row.lot_code,
-            "itemNo": row.item_no,
-            "description": row.description,
-            "quantity": float(row.quantity) if row.quantity else 0,
-            "unitOfMeasure": row.unit_of_measure,
-            "entryType": row.entry_type,
-            "postingDate": str(row.posting_date) if row.posting_date else None,
-            "documentType": row.document_type,
-            "depth": row.depth,
-            "path": row.path
-        }
-        for row in destinations_data
-    ]
+    # Collect the lineage rows once through Arrow, with the JSON conversions (quantity as a
+    # number, dates as text, the path as "lot -> lot" text) done in Spark, and separate them
+    # by queried lot and relationship
+    df_collected = df_lineage.select(
+        *[
+            (col(name).cast("double") if name == "quantity"
+             else col(name).cast("string") if name in ("posting_date", "purchase_date")
+             else array_join(col(name).cast("array<string>"), " -> ") if name == "path"
+             else col(name)).alias(name)
+            for name in df_lineage.columns
+        ]
+    )
+    pdf = df_collected.toPandas()
     
-    # Collect details (current lot records)
-    details_data = df_current.collect()
-    result["lineageTree"]["details"] = [
-        {
-            "lotNo": row.lot_no,
-            "prodOrderNo": row.prod_order_no,
-            "itemNo": row.item_no,
-            "description": row.description,
-            "quantity": float(row.quantity) if row.quantity else 0,
-            "entryType": row.entry_type,
-            "postingDate": str(row.posting_date) if row.posting_date else None,
-            "supplier": row.supplier,
-            "origin": row.origin
-        }
-        for row in details_data
-    ]
+    # Keep the exported values as the per-row conversion made them: Arrow turns integer
+    # columns holding nulls into floats, so restore them as nullable integers (a lot code
+    # stays 123, not 123.0), and a missing or zero quantity is exported as 0
+    for field in df_collected.schema.fields:
+        if isinstance(field.dataType, IntegralType):
+            pdf[field.name] = pdf[field.name].astype("Int64")
+    no_quantity = pdf["quantity"].fillna(0) == 0
+    pdf = pdf.astype(object).where(pdf.notna(), None)
+    pdf.loc[no_quantity, "quantity"] = 0
+    frames_by_seed = {key: {} for key in lot_keys}
+    for (seed_lot, relationship_type), frame in pdf.groupby(["seed_lot", "relationship_type"], sort=False):
+        frames_by_seed[seed_lot][relationship_type] = frame
     
-    # Calculate statistics
-    total_records = df_lineage.count()
-    total_consumed = df_lineage.filter(col("entry_type") == "Consumption").agg(
-        spark_sum("quantity").alias("sum")
-    ).collect()[0]["sum"] or 0
+    # Calculate statistics in one aggregation over the cached lineage rows
+    stats_by_seed = {
+        row["seed_lot"]: row
+        for row in df_lineage.groupBy("seed_lot").agg(
+            count(lit(1)).alias("total_records"),
+            spark_sum(when(col("entry_type") == "Consumption", col("quantity"))).alias("total_consumed"),
+            spark_sum(when(col("entry_type") == "Output", col("quantity"))).alias("total_produced"),
+            countDistinct("lot_no").alias("unique_lots"),
+            spark_max("depth").alias("max_depth")
+        ).collect()
+    }
+    df_lineage.unpersist()
     
-    total_produced = df_lineage.filter(col("entry_type") == "Output").agg(
-        spark_sum("quantity").alias("sum")
-    ).collect()[0]["sum"] or 0
+    return {
+        key: build_lineage_result(key, frames_by_seed[key], stats_by_seed.get(key))
+        for key in lot_keys
+    }
+
+def trace_lot_lineage(lot_no, max_depth=10):
+    """Trace lineage for a single lot, see trace_lots_lineage"""
+    return trace_lots_lineage([lot_no], max_depth)[lineage_key(lot_no)]
+
+def build_lineage_result(lot_no, frames_by_relationship, stats):
+    """
+    Lineage result of a queried lot from its collected rows (pandas frames by relationship
+    type) and its aggregated statistics (None when the lot has no records)
+    """
+    def records(relationship, fields):
+        frame = frames_by_relationship.get(relationship)
+        if frame is None:
+            return []
+        return frame[list(fields.values())].set_axis(list(fields), axis=1).to_dict("records")
     
-    unique_lots = df_lineage.select("lot_no").distinct().count()
-    max_depth_val = df_lineage.agg(spark_max("depth").alias("max")).collect()[0]["max"] or 0
+    origins = records("origin", ORIGIN_FIELDS)
+    destinations = records("destination", DESTINATION_FIELDS)
     
-    result["statistics"] = {
-        "totalRecords": total_records,
-        "totalConsumed": float(total_consumed),
-        "totalProduced": float(total_produced),
-        "uniqueLots": unique_lots,
-        "maxDepth": max_depth_val,
-        "originCount": len(origins_data),
-        "destinationCount": len(destinations_data)
+    return {
+        "queriedLot": lot_no,
+        "lineageTree": {
+            "lotNo": lot_no,
+            "origins": origins,
+            "destinations": destinations,
+            "details": records("current", DETAIL_FIELDS)
+        },
+        "statistics": {
+            "totalRecords": stats["total_records"] if stats else 0,
+            "totalConsumed": float(stats["total_consumed"] or 0) if stats else 0.0,
+            "totalProduced": float(stats["total_produced"] or 0) if stats else 0.0,
+            "uniqueLots": stats["unique_lots"] if stats else 0,
+            "maxDepth": (stats["max_depth"] or 0) if stats else 0,
+            "originCount": len(origins),
+            "destinationCount": len(destinations)
+        }
     }
-    
-    return result
 
 # ============================================================================
 # STEP 5: Test Lineage Tracing with Sample Lot
@@ -390,7 +555,7 @@ def trace_lot_lineage(lot_no, max_depth=10):
 print("\n[STEP 5] Testing lineage tracing...")
 
 # Get a sample lot number to test
-sample_lot = df_enriched.select("lot_no").filter(col("lot_no").isNotNull()).first()["lot_no"]
+sample_lot = df_lineage_source.select("lot_no").filter(col("lot_no").isNotNull()).first()["lot_no"]
 print(f"  Testing with sample lot: {sample_lot}")
 
 start_time = time.time()
@@ -417,10 +582,12 @@ if len(sale_contracts) > 0:
     
     start_time = time.time()
     
-    # Get production lots for this sale contract
-    production_lots = df_purchase_mapping.filter(
-        col("sale_contract") == sample_contract
-    ).select("production_lot").distinct().rdd.flatMap(lambda x: x).collect()
+    # Get production lots for this sale contract, each with its first mapping row,
+    # from one collect of the contract's rows
+    lot_details_by_lot = {}
+    for row in df_purchase_mapping.filter(col("sale_contract") == sample_contract).collect():
+        lot_details_by_lot.setdefault(row.production_lot, row)
+    production_lots = list(lot_details_by_lot)
     
     purchase_result = {
         "saleContract": sample_contract,
@@ -428,12 +595,13 @@ if len(sale_contracts) > 0:
         "lineages": []
     }
     
+    # Trace all sampled production lots in one batched lineage query
+    sampled_lots = production_lots[:5]  # Limit to first 5 for testing
+    sampled_lineages = trace_lots_lineage(sampled_lots, max_depth=5)
+    
     # Get details for each production lot
-    for prod_lot in production_lots[:5]:  # Limit to first 5 for testing
-        lot_details = df_purchase_mapping.filter(
-            (col("sale_contract") == sample_contract) & 
-            (col("production_lot") == prod_lot)
-        ).first()
+    for prod_lot in sampled_lots:
+        lot_details = lot_details_by_lot[prod_lot]
         
         purchase_result["productionLots"].append({
             "lotNo": prod_lot,
@@ -442,9 +610,7 @@ if len(sale_contracts) > 0:
             "postingDate": str(lot_details.posting_date) if lot_details.posting_date else None
         })
         
-        # Trace lineage for this production lot
-        lot_lineage = trace_lot_lineage(prod_lot, max_depth=5)
-        purchase_result["lineages"].append(lot_lineage)
+        purchase_result["lineages"].append(sampled_lineages[lineage_key(prod_lot)])
     
     purchase_time = time.time() - start_time
     
@@ -489,10 +655,14 @@ final_output = {
 if len(sale_contracts) > 0:
     final_output["samplePurchaseLotLineage"] = purchase_result
 
-# Save to JSON file
+# Save to JSON file, compact (no indentation) and with orjson when installed
 output_path = "/lakehouse/default/Files/lineage_output.json"
-with open(output_path, 'w') as f:
-    json.dump(final_output, f, indent=2)
+if orjson is not None:
+    with open(output_path, 'wb') as f:
+        f.write(orjson.dumps(final_output, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS))
+else:
+    with open(output_path, 'w') as f:
+        json.dump(final_output, f, separators=(",", ":"))
 
 print(f"✓ Results exported to: {output_path}")
 
@@ -500,6 +670,10 @@ print(f"✓ Results exported to: {output_path}")
 print("\n" + "=" * 80)
 print("SAMPLE LINEAGE JSON OUTPUT")
 print("=" * 80)
-print(json.dumps(lineage_result, indent=2)[:2000] + "...")  # First 2000 chars
+if orjson is not None:
+    sample_json = orjson.dumps(lineage_result, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY).decode()
+else:
+    sample_json = json.dumps(lineage_result, indent=2)
+print(sample_json[:2000] + "...")  # First 2000 chars
 
 print("\n✓ Processing complete! Check the full JSON output in the exported file.")